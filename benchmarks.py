@@ -0,0 +1,103 @@
+import os
+import sys
+import statistics
+import subprocess
+import threading
+import time
+import json
+import urllib.request
+
+# Maximum median time (in seconds) allowed to import a module of the project
+IMPORT_TIME_TARGET = 1.0
+
+
+def benchmark_import_time(module_name='data_science_functions', repeat=5,
+                          target=IMPORT_TIME_TARGET):
+    """ Measure the time needed to import 'module_name' in fresh python
+    processes (interpreter start-up excluded) and compare its median over
+    'repeat' runs to 'target'.
+
+    Return (median_time, is_under_target)."""
+    code = ("import time; start = time.perf_counter(); "
+            f"import {module_name}; print(time.perf_counter() - start)")
+    durations = []
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, '-c', code],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        durations.append(float(completed.stdout))
+    median_time = statistics.median(durations)
+    is_under_target = median_time <= target
+    print(f"import {module_name} : {median_time:.3f}s (median of {repeat}) "
+          f"- target {target}s : {'OK' if is_under_target else 'TOO SLOW'}")
+    return median_time, is_under_target
+
+
+def _latencies(func, n_requests):
+    func()  # warm-up
+    durations = []
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def benchmark_segment_latency(model, clients, n_requests=200,
+                              batch_sizes=(1, 1000)):
+    """ Measure the latency of segment assignments (see segment_service)
+    for requests of 'batch_sizes' rows of the raw 'clients' summary :
+    direct call, through the micro-batcher and through the local HTTP
+    server.
+
+    Return a DataFrame of the p50 and p99 latencies (in ms) per
+    (api, batch size)."""
+    import pandas as pd
+    import segment_service as ss
+
+    server = ss.make_segment_server(model, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/segments'
+
+    def post(body):
+        request = urllib.request.Request(
+            url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            response.read()
+
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            batch = clients.sample(batch_size, replace=True, random_state=0)
+            body = json.dumps(batch.reset_index()
+                              .to_dict(orient='records')).encode()
+            apis = {
+                'direct': lambda: ss.assign_segments(model, batch),
+                'micro_batcher': lambda: server.batcher.assign(batch),
+                'http': lambda: post(body),
+            }
+            for api, func in apis.items():
+                durations = _latencies(func, n_requests)
+                p50, p99 = statistics.quantiles(durations, n=100)[49::49]
+                results.append({'api': api, 'batch_size': batch_size,
+                                'p50_ms': p50 * 1000, 'p99_ms': p99 * 1000})
+    finally:
+        server.shutdown()
+        server.server_close()
+        server.batcher.close()
+    results = pd.DataFrame(results).set_index(['api', 'batch_size'])
+    print(results.round(3))
+    return results
+
+
+if __name__ == '__main__':
+    _, is_under_target = benchmark_import_time()
+    if len(sys.argv) == 3:
+        # python benchmarks.py <segment model path> <clients summary pickle>
+        import pandas as pd
+        import segment_service as ss
+        benchmark_segment_latency(ss.load_segment_model(sys.argv[1]),
+                                  pd.read_pickle(sys.argv[2]))
+    sys.exit(0 if is_under_target else 1)
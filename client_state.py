@@ -0,0 +1,290 @@
+import os
+import json
+
+import pandas as pd
+import numpy as np
+
+import project_tools_v2 as pt
+
+
+# Aggregates of 'client_summary' kept per client, with the order summary
+# column they are computed from ('<name>_sum' and '<name>_count' are kept
+# for the averaged ones).
+_averaged_fields = {'order_cost': 'order_cost',
+                    'n_items': 'n_items',
+                    'review_score': 'review_score',
+                    'delay': 'delay_purchase_delivery'}
+_min_fields = {'n_items_min': 'n_items',
+               'review_score_min': 'review_score',
+               'delay_min': 'delay_purchase_delivery'}
+_max_fields = {'n_items_max': 'n_items',
+               'review_score_max': 'review_score',
+               'delay_max': 'delay_purchase_delivery',
+               'payment_installments_max': 'payment_installments'}
+
+
+def _summed_columns(columns):
+    """ Columns of an order summary summed per client in 'client_summary'."""
+    return [
+        *[col for col in columns if col.startswith('value_')],
+        'freight_value',
+        *[col for col in columns if col.startswith('payment_value')]
+    ]
+
+
+def _to_json_value(value):
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ClientStateStore:
+    """ Online clients summary : running aggregates per customer_unique_id,
+    updated in O(1) per incoming order summary row (a row of
+    'pt.make_orders_summary').
+
+    'summary(date)' gives the same columns as 'pt.make_clients_summary' on
+    all the ingested orders post-processed relatively to 'date', deriving
+    the date-relative fields on read ; 'date' can't be earlier than one day
+    after the last ingested purchase.
+
+    If 'log_path' is given, each ingested order is appended to that local
+    JSON-lines log, which 'from_log' replays."""
+
+    def __init__(self, log_path=None):
+        self.log_path = log_path
+        self.summed_cols = None
+        self._clients = {}
+        self._order_ids = set()
+        # Per order, to split the orders of a client in halves on read.
+        self._order_clients = []
+        self._order_times = []
+        self._order_costs = []
+
+    def __len__(self):
+        return len(self._clients)
+
+    def update(self, order, order_id=None):
+        """ Ingest an order summary row (pd.Series or dict), return False if
+        its 'order_id' (or the 'order_id' argument) was already ingested.
+
+        The order is applied before being recorded and logged : an invalid
+        order raises without being logged, and can be retried."""
+        order = dict(order)
+        order_id = order.get('order_id', order_id)
+        if order_id is not None:
+            if order_id in self._order_ids:
+                return False
+            order['order_id'] = order_id
+        line = json.dumps({key: _to_json_value(value)
+                           for key, value in order.items()}) + '\n'
+        self._apply(order)
+        if order_id is not None:
+            self._order_ids.add(order_id)
+        if self.log_path is not None:
+            with open(self.log_path, 'a') as f:
+                f.write(line)
+        return True
+
+    def update_many(self, orders_df):
+        """ Ingest all the rows of an orders summary df, return the number
+        of orders that were not already ingested."""
+        return sum(self.update(order)
+                   for order in orders_df.to_dict(orient='records'))
+
+    def _apply(self, order):
+        # Parse the whole order before modifying the state.
+        summed_cols = (self.summed_cols if self.summed_cols is not None
+                       else _summed_columns(order))
+        purchase_time = pd.Timestamp(order['purchase_time'])
+        delivery_time = pd.Timestamp(order['delivery_time'])
+        values = {key: order[key] for key in ('order_cost', 'n_items',
+                                               'review_score',
+                                               'payment_installments')}
+        values['delay_purchase_delivery'] = (
+            (delivery_time - purchase_time).days
+            if delivery_time is not pd.NaT else np.nan
+        )
+        values = {key: (np.nan if value is None else float(value))
+                  for key, value in values.items()}
+        sums = {col: float(order[col]) for col in summed_cols
+                if order.get(col) is not None}
+        paid_less_than_due = bool((order['order_cost_minus_payment'] or 0) > 0)
+        is_not_delivered = order['binary_order_status'] == 'not_delivered'
+        week_moment = pt.map_moment_of_the_week(purchase_time.day_of_week)
+        day_moment = pt.map_moment_of_the_day(purchase_time.hour)
+        client_id = order['customer_unique_id']
+
+        self.summed_cols = summed_cols
+        state = self._clients.get(client_id)
+        if state is None:
+            state = {
+                'position': len(self._clients),
+                'n_orders': 0,
+                **{f'{name}_sum': 0. for name in _averaged_fields},
+                **{f'{name}_count': 0 for name in _averaged_fields},
+                **{field: np.nan for field in _min_fields},
+                **{field: np.nan for field in _max_fields},
+                'paid_less_than_due': False,
+                'has_had_a_non_delivered_order': False,
+                'sums': dict.fromkeys(self.summed_cols, 0.),
+                'week_moments': {},
+                'day_moments': {},
+                'first_purchase_time': purchase_time,
+                'last_purchase_time': purchase_time,
+            }
+            self._clients[client_id] = state
+
+        state['n_orders'] += 1
+        for name, key in _averaged_fields.items():
+            if not np.isnan(values[key]):
+                state[f'{name}_sum'] += values[key]
+                state[f'{name}_count'] += 1
+        for field, key in _min_fields.items():
+            state[field] = np.fmin(state[field], values[key])
+        for field, key in _max_fields.items():
+            state[field] = np.fmax(state[field], values[key])
+        state['paid_less_than_due'] |= paid_less_than_due
+        state['has_had_a_non_delivered_order'] |= is_not_delivered
+        for col, value in sums.items():
+            if not np.isnan(value):
+                state['sums'][col] += value
+        for moments, moment in (('week_moments', week_moment),
+                                ('day_moments', day_moment)):
+            state[moments][moment] = state[moments].get(moment, 0) + 1
+        state['first_purchase_time'] = min(state['first_purchase_time'],
+                                           purchase_time)
+        state['last_purchase_time'] = max(state['last_purchase_time'],
+                                          purchase_time)
+
+        self._order_clients.append(state['position'])
+        self._order_times.append(purchase_time.value)
+        self._order_costs.append(values['order_cost'])
+
+    @classmethod
+    def from_log(cls, log_path):
+        """ Rebuild a store by replaying the JSON-lines log at 'log_path';
+        the orders ingested afterwards are appended to the same log.
+
+        An incomplete last line (interrupted write) is dropped from the
+        log."""
+        store = cls()
+        if os.path.exists(log_path):
+            with open(log_path, 'rb') as f:
+                content = f.read()
+            complete_size = content.rfind(b'\n') + 1
+            if complete_size < len(content):
+                with open(log_path, 'r+b') as f:
+                    f.truncate(complete_size)
+            for line in content[:complete_size].splitlines():
+                store.update(json.loads(line))
+        store.log_path = log_path
+        return store
+
+    @staticmethod
+    def _preferred_moment(moments_counts):
+        counts = sorted(moments_counts.values(), reverse=True)
+        if len(counts) == 1 or counts[0] > counts[1]:
+            return max(moments_counts, key=moments_counts.get)
+        return np.nan
+
+    def _date_relative_values(self, date):
+        """ 'pt.values_relatives_to_date_for_a_client' for all clients."""
+        day = pd.Timedelta(days=1).value
+        clients = np.array(self._order_clients)
+        elapsed_days = (pd.Timestamp(date).value
+                        - np.array(self._order_times)) // day
+        costs = np.nan_to_num(np.array(self._order_costs))
+
+        n_clients = len(self._clients)
+        days_last_purchase, days_first_purchase = (
+            (pd.Timestamp(date).value
+             - np.array([state[field].value
+                         for state in self._clients.values()])) // day
+            for field in ('last_purchase_time', 'first_purchase_time')
+        )
+        days_middle = days_first_purchase / 2
+        is_first_half = elapsed_days >= days_middle[clients]
+
+        n_first_half = np.bincount(clients, weights=is_first_half,
+                                   minlength=n_clients).astype(int)
+        n_orders = np.bincount(clients, minlength=n_clients).astype(int)
+        value_first_half = np.bincount(clients,
+                                       weights=costs * is_first_half,
+                                       minlength=n_clients)
+        value_second_half = np.bincount(clients,
+                                        weights=costs * ~is_first_half,
+                                        minlength=n_clients)
+        return pd.DataFrame({
+            'days_last_purchase': days_last_purchase,
+            'days_first_purchase': days_first_purchase,
+            'days_middle': days_middle,
+            'number_of_purchases_first_half': n_first_half,
+            'number_of_purchases_second_half': n_orders - n_first_half,
+            'value_spent_first_half': value_first_half,
+            'value_spent_second_half': value_second_half,
+        }, index=pd.Index(self._clients, name='customer_unique_id'))
+
+    def summary(self, date):
+        """ Return the post-processed clients summary relatively to
+        'date', as 'pt.make_clients_summary' would on the ingested
+        orders.
+
+        The running aggregates can't exclude orders : 'date' must be at
+        least one day after the last ingested purchase, so that all the
+        orders are in the summary at that date (as in
+        'pt.make_clients_summary_relative_to_a_date_for_clustering'),
+        otherwise a ValueError is raised."""
+        if self._order_times:
+            last_purchase_time = pd.Timestamp(max(self._order_times))
+            if (pd.Timestamp(date) - last_purchase_time).days <= 0:
+                raise ValueError(
+                    f"Can't summarize at {date} : orders were ingested up to "
+                    f"{last_purchase_time}, the date must be at least one "
+                    "day later.")
+        rows = []
+        for state in self._clients.values():
+            n_orders = state['n_orders']
+            rows.append({
+                'monetary_value_sum': state['order_cost_sum'],
+                'monetary_value_mean_per_order': (
+                    state['order_cost_sum'] / state['order_cost_count']
+                    if state['order_cost_count'] else np.nan),
+                'total_number_of_purchases': n_orders,
+                'max_number_of_items_ordered': state['n_items_max'],
+                'min_number_of_items_ordered': state['n_items_min'],
+                'mean_number_of_items_per_order': (
+                    state['n_items_sum'] / state['n_items_count']
+                    if state['n_items_count'] else np.nan),
+                'review_score_mean': (
+                    state['review_score_sum'] / state['review_score_count']
+                    if state['review_score_count'] else np.nan),
+                'review_score_min': state['review_score_min'],
+                'review_score_max': state['review_score_max'],
+                'paid_less_than_due': state['paid_less_than_due'],
+                'has_had_a_non_delivered_order': (
+                    state['has_had_a_non_delivered_order']),
+                'has_contracted_payment_installments': (
+                    state['payment_installments_max'] > 1),
+                'days_delivery_min': state['delay_min'],
+                'days_delivery_max': state['delay_max'],
+                'days_delivery_mean': (
+                    state['delay_sum'] / state['delay_count']
+                    if state['delay_count'] else np.nan),
+                'preferred_week_moment_to_purchase': (
+                    self._preferred_moment(state['week_moments'])
+                    if n_orders > 1 else np.nan),
+                'preferred_day_moment_to_purchase': (
+                    self._preferred_moment(state['day_moments'])
+                    if n_orders > 1 else np.nan),
+                **state['sums'],
+            })
+        clients = pd.DataFrame(
+            rows, index=pd.Index(self._clients, name='customer_unique_id'))
+        clients = pd.concat([clients, self._date_relative_values(date)],
+                            axis=1)
+        return pt.clients_summary_post_processing(clients.sort_index())
@@ -1,24 +1,23 @@
+""" Generic data science helpers (EDA, PCA, encoding, model evaluation
+and clustering displays).
+
+Heavy dependencies (matplotlib, seaborn, scipy, sklearn, xgboost, colorcet)
+are imported inside the functions using them, so that importing this module
+only costs the import of pandas and numpy.
+"""
+import os
+import json
+import time
+import pickle
+import hashlib
+import multiprocessing
+import multiprocessing.connection
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import seaborn as sns
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.model_selection import KFold
-from sklearn.model_selection import cross_val_score
-from sklearn.model_selection import cross_val_predict
-
-from sklearn.metrics import r2_score
-from sklearn.metrics import PredictionErrorDisplay
-from sklearn.metrics import silhouette_samples
-from sklearn.metrics import silhouette_score
-
-from scipy.stats import pearsonr
-from scipy.cluster.hierarchy import dendrogram
-
-import xgboost as xgb
 
-import colorcet as cc
   
 # NUMERICAL/NUMERICAL Analysis
 def display_correlation_matrix(data, features=None, figsize=(11,9)):
@@ -27,6 +26,8 @@ def display_correlation_matrix(data, features=None, figsize=(11,9)):
     'features' : enable features restriction.
         When None, display the correlation matrix for all numerical
         columns."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     sns.set_theme(style="white")
     # Select 'features' or numerical columns
     if features is not None:
@@ -73,6 +74,9 @@ def numerical_numerical_analysis(
     log_scale=False,
     precision=3,
 ):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from scipy.stats import pearsonr
     if log_effectives:
         x = data[ft1_name]
         y = data[ft2_name]
@@ -142,6 +146,7 @@ def categorical_numerical_correlation(
     """Plot a unique figure with multiple boxplot (one per each
     category of the categorical feature). Also compute the squared
     non-linear correlation coefficient."""
+    import matplotlib.pyplot as plt
     fts = [cat_name, num_name]
     mask = data[cat_name].notnull() & data[num_name].notnull()
     df = data.loc[mask, fts]
@@ -192,14 +197,18 @@ def categorical_numerical_correlation(
 
 
 def display_correlation_circle(
-    pca, axis_ranks, features_name=None, label_rotation=0, lims=None, figsize=(7, 7)
+    pca, axis_ranks, features_name=None, label_rotation=0, lims=None, figsize=(7, 7),
+    show=True,
 ):
     """Display the correlation circle in a given factorial plane.
 
     pca : the sklearn fit pca.
     axis_ranks : t-uple.
         e.g. (0,1) to display the plane of basis (pc1, pc2).
-    features_name : list of the features names."""
+    features_name : list of the features names.
+    show : when False, return the figure instead of displaying it."""
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
     pcs = pca.components_
     n_comp = pca.n_components_
     d1, d2 = axis_ranks
@@ -268,6 +277,8 @@ def display_correlation_circle(
         plt.ylabel("PC{} ({}%)".format(d2 + 1, pct_var_d2))
         # Add title
         plt.title("Correlation Circle (PC{} and PC{})".format(d1 + 1, d2 + 1))
+        if not show:
+            return fig
         plt.show(block=False)
     return None
 
@@ -286,6 +297,8 @@ def display_factorial_plane_projection(
     labels : list of the labels to be displayed above each point.
     illustrative_var :
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     n_comp = pca.n_components_
     d1, d2 = axis_ranks
     
@@ -353,8 +366,11 @@ def display_factorial_plane_projection(
     return None
 
 
-def display_scree_plot(pca):
-    """Display a scree plot for the pca"""
+def display_scree_plot(pca, show=True):
+    """Display a scree plot for the pca.
+
+    show : when False, return the figure instead of displaying it."""
+    import matplotlib.pyplot as plt
 
     fig, ax = plt.subplots(figsize=(7, 5))
     scree = pca.explained_variance_ratio_ * 100
@@ -367,6 +383,8 @@ def display_scree_plot(pca):
     ax.yaxis.grid(color="gray", linestyle="dashed")
     plt.yticks(np.arange(0, 100 + 1, 10))
     plt.title("Scree plot")
+    if not show:
+        return fig
     plt.show(block=False)
     return None
 
@@ -377,24 +395,50 @@ def chunk_list(l, chunk_size):
 
 
 # ENCODING
-def one_hot_encoding(data, cols, drop=None):
+def one_hot_encoding(
+    data, cols, drop=None, sparse=False, min_frequency=None,
+    max_categories=None, handle_unknown='error', enc=None
+):
     """Add one_hot encoded columns to the 'data' dataframe.
 
     cols : must be a list of columns names to be one-hot encoded.
     It is also possible to pass drop in order to avoid multicolinearity.
+    sparse : when True, encoded columns are added as pandas sparse uint8
+        columns which keeps memory low for high-cardinality features.
+    min_frequency, max_categories : group infrequent categories in a single
+        '<col>_infrequent_sklearn' column (see sklearn OneHotEncoder).
+    handle_unknown : passed to the OneHotEncoder. Use 'ignore' (or
+        'infrequent_if_exist' when grouping) to encode later batches which
+        may contain new categories.
+    enc : an encoder already fit by this function. When provided, it is
+        only used to transform 'data' (e.g. a new batch).
 
     Return the fit encoder and the modified dataset (enc, data)."""
-    enc = OneHotEncoder(drop=drop)
+    from sklearn.preprocessing import OneHotEncoder
     # Ensure input shape compatibility
     if len(cols) == 1:
         data_to_encode = np.array(data.loc[:, cols]).reshape(-1, 1)
     else:
         data_to_encode = data.loc[:, cols]
-    # Fit, transform and add to the initial dataframe
-    encoded_array = enc.fit_transform(data_to_encode).toarray()
-    df_encoded = pd.DataFrame(
-        encoded_array, index=data.index, columns=enc.get_feature_names_out(cols)
-    )
+    # Fit (if needed), transform and add to the initial dataframe
+    if enc is None:
+        enc = OneHotEncoder(drop=drop,
+                            min_frequency=min_frequency,
+                            max_categories=max_categories,
+                            handle_unknown=handle_unknown,
+                            dtype=np.uint8 if sparse else np.float64)
+        encoded_matrix = enc.fit_transform(data_to_encode)
+    else:
+        encoded_matrix = enc.transform(data_to_encode)
+    encoded_cols = enc.get_feature_names_out(cols)
+    if sparse:
+        df_encoded = pd.DataFrame.sparse.from_spmatrix(
+            encoded_matrix, index=data.index, columns=encoded_cols
+        )
+    else:
+        df_encoded = pd.DataFrame(
+            encoded_matrix.toarray(), index=data.index, columns=encoded_cols
+        )
     data = pd.concat([data, df_encoded], axis=1)
     # if initial_drop:
     #     data = data.drop(labels= cols, axis=1)
@@ -404,6 +448,7 @@ def one_hot_encoding(data, cols, drop=None):
 ### Linear regressions
 def linearRegressionSummary(model, column_names):
     '''Show a summary of the trained linear regression model'''
+    import matplotlib.pyplot as plt
 
     # Plot the coeffients as bars
     fig = plt.figure(figsize=(8, len(column_names)/3))
@@ -447,36 +492,139 @@ def score(model, metric, X, y_true, precision=5):
     )
     return None
 
+def score_metrics(
+    model, metrics, X, y_true, precision=5,
+    n_bootstrap=0, confidence=0.95, seed=0,
+):
+    """ Predict X once and compute all the 'metrics' on those predictions.
+
+    metrics : the metrics dataframe (one row per metric, indexed by name,
+        with 'func' and 'kwargs' columns) used by 'apply_score_func'.
+    n_bootstrap : when > 0, also compute the 'confidence' interval of each
+        score over n_bootstrap resamples of the test set. Resamples are
+        drawn and gathered by blocks, shared by all the metrics.
+
+    Return a dataframe indexed by metric name with a 'score' column and,
+    with bootstrap, 'ci_low' and 'ci_high' columns."""
+    y_pred = np.asarray(model.predict(X))
+    y_true = np.asarray(y_true)
+    table = pd.DataFrame(
+        {'score': [apply_score_func(metric, y_true, y_pred, precision)
+                   for _, metric in metrics.iterrows()]},
+        index=metrics.index,
+    )
+
+    if n_bootstrap > 0:
+        rng = np.random.default_rng(seed)
+        n_samples = len(y_true)
+        funcs = [(metric.func,
+                  metric.kwargs if metric.kwargs is not None else {})
+                 for _, metric in metrics.iterrows()]
+        # Resamples are drawn and gathered by blocks of (at most 64)
+        # resamples, bounded to about 4M gathered values per block.
+        block_size = max(1, min(64, 2 ** 22 // max(n_samples, 1)))
+        bootstrap_scores = np.empty((n_bootstrap, len(metrics)))
+        for start in range(0, n_bootstrap, block_size):
+            stop = min(start + block_size, n_bootstrap)
+            resamples = rng.integers(0, n_samples,
+                                     size=(stop - start, n_samples))
+            y_true_block, y_pred_block = y_true[resamples], y_pred[resamples]
+            for m, (func, kwargs) in enumerate(funcs):
+                bootstrap_scores[start:stop, m] = [
+                    func(y_true_b, y_pred_b, **kwargs)
+                    for y_true_b, y_pred_b in zip(y_true_block, y_pred_block)
+                ]
+        alpha = (1 - confidence) / 2
+        ci_low, ci_high = np.quantile(bootstrap_scores, [alpha, 1 - alpha],
+                                      axis=0)
+        table['ci_low'] = np.round(ci_low, precision)
+        table['ci_high'] = np.round(ci_high, precision)
+    return table
+
+
+# Folds indices already computed, per (n_samples, k, seed)
+_kfold_indices_cache = {}
+
+
+def kfold_indices(n_samples, k=5, seed=2):
+    """ Return the list of (train_idx, test_idx) of a shuffled k-fold.
+
+    Shuffled KFold splits only depend on the number of samples, k and the
+    seed : they are computed once and reused, so that models compared on
+    the same data are evaluated on exactly the same folds."""
+    from sklearn.model_selection import KFold
+    key = (n_samples, k, seed)
+    if key not in _kfold_indices_cache:
+        kfold = KFold(n_splits=k, shuffle=True, random_state=seed)
+        _kfold_indices_cache[key] = list(kfold.split(np.empty((n_samples, 1))))
+    return _kfold_indices_cache[key]
+
+
 def CV_evaluation(
         model, X, y, k=5, scoring="r2", seed=2,
-        silent=False, precision=3
+        silent=False, precision=3, n_jobs=None, return_times=False,
     ):
-    """Evaluate a model with the k-fold cross validation method."""
-    # Create folds
-    kfold = KFold(n_splits=k, shuffle=True, random_state=seed)
-    
-    # Compute scores on folds
-    results = cross_val_score(model, X, y, cv=kfold, scoring=scoring)
-    
-    # Compute mean and std, then round
-    mean_score = np.round(results.mean(), precision)
-    std_score = np.round(results.std(), precision)
-    results = np.round(results, precision)
-    
-    # Handle cases where loss minimization is processed as 
-    # negative maximization
-    if scoring.startswith("neg_"):
-        mean_score = - mean_score
-        results = results * (-1)
-        scoring = scoring.lstrip("neg_")  
-    
-    # Print results    
-    if not silent:
-        print(f"Cross-validation evaluation : ")
-        print("    scores on folds: ", results)
-        print("    mean score: ", mean_score)
-        print("    std score deviation: ", std_score)
-    return (results, mean_score, std_score)
+    """Evaluate a model with the k-fold cross validation method.
+
+    scoring : a sklearn scorer name, or a list of names. With a list, all
+        the metrics are computed from the same fits and the returned
+        results, means and stds are a dataframe (folds x metrics) and
+        2 series.
+    n_jobs : number of folds fit in parallel.
+    return_times : also return a dataframe of the fit and score times
+        (in seconds) of each fold.
+
+    Return (results, mean_score, std_score) or
+    (results, mean_score, std_score, times)."""
+    from sklearn.model_selection import cross_validate
+    scorings = [scoring] if isinstance(scoring, str) else list(scoring)
+
+    # Compute scores of all metrics on the same folds and fits
+    cv_results = cross_validate(
+        model, X, y, cv=kfold_indices(len(X), k, seed),
+        scoring=scorings, n_jobs=n_jobs,
+    )
+    
+    all_results = {}
+    for metric in scorings:
+        results = cv_results['test_' + metric]
+        # Compute mean and std, then round
+        mean_score = np.round(results.mean(), precision)
+        std_score = np.round(results.std(), precision)
+        results = np.round(results, precision)
+
+        # Handle cases where loss minimization is processed as
+        # negative maximization
+        if metric.startswith("neg_"):
+            mean_score = - mean_score
+            results = results * (-1)
+            metric = metric[len("neg_"):]
+        all_results[metric] = (results, mean_score, std_score)
+
+        # Print results
+        if not silent:
+            print("Cross-validation evaluation : "
+                  + (metric if len(scorings) > 1 else ""))
+            print("    scores on folds: ", results)
+            print("    mean score: ", mean_score)
+            print("    std score deviation: ", std_score)
+
+    times = pd.DataFrame({'fit_time': cv_results['fit_time'],
+                          'score_time': cv_results['score_time']})
+    if not silent and return_times:
+        print("    mean fit time (s): ", np.round(times.fit_time.mean(), 3))
+
+    if isinstance(scoring, str):
+        output = all_results[metric]
+    else:
+        output = (
+            pd.DataFrame({m: r[0] for m, r in all_results.items()}),
+            pd.Series({m: r[1] for m, r in all_results.items()}),
+            pd.Series({m: r[2] for m, r in all_results.items()}),
+        )
+    if return_times:
+        output = (*output, times)
+    return output
 
 
 def plot_predictions_vs_real_values(
@@ -484,6 +632,8 @@ def plot_predictions_vs_real_values(
 ):
     """ Plot actual and residuals of predictions vs real values by 
     default. This can be changed through the boolean parameters. """
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import PredictionErrorDisplay
     if show_actual:
         # displaying predictions vs real values
         _, ax = plt.subplots(figsize=(5, 5))
@@ -504,24 +654,126 @@ def plot_predictions_vs_real_values(
         plt.show()
     return None
 
+def accumulate_prediction_error_histograms(
+    batches, value_range, residual_range=None, bins=100,
+):
+    """ Accumulate the 2D histograms of the predictions error displays over
+    (y_true, y_pred) batches, e.g. a generator predicting a large test set
+    chunk by chunk. Memory stays constant whatever the number of
+    predictions.
+
+    value_range : (min, max) of the real values and of the predictions.
+    residual_range : (min, max) of the residuals (y_true - y_pred).
+        Defaults to plus or minus the width of value_range.
+
+    Return a dictionary with the counts and bins edges of the
+    'actual_vs_predicted' and 'residual_vs_predicted' histograms (x is
+    the prediction), the number of predictions and how many of them
+    fell out of the ranges."""
+    low, high = value_range
+    if residual_range is None:
+        residual_range = (low - high, high - low)
+    value_edges = np.linspace(low, high, bins + 1)
+    residual_edges = np.linspace(*residual_range, bins + 1)
+    actual_counts = np.zeros((bins, bins), dtype=np.int64)
+    residual_counts = np.zeros((bins, bins), dtype=np.int64)
+    n_predictions = 0
+    n_out_of_range = 0
+
+    for y_true, y_pred in batches:
+        y_true = np.asarray(y_true, dtype=float).ravel()
+        y_pred = np.asarray(y_pred, dtype=float).ravel()
+        residuals = y_true - y_pred
+        counts, _, _ = np.histogram2d(y_pred, y_true,
+                                      bins=[value_edges, value_edges])
+        actual_counts += counts.astype(np.int64)
+        counts, _, _ = np.histogram2d(y_pred, residuals,
+                                      bins=[value_edges, residual_edges])
+        residual_counts += counts.astype(np.int64)
+        n_predictions += len(y_pred)
+        n_out_of_range += np.count_nonzero(
+            (y_pred < low) | (y_pred > high)
+            | (y_true < low) | (y_true > high)
+            | (residuals < residual_range[0]) | (residuals > residual_range[1])
+        )
+
+    return {
+        'actual_vs_predicted': (actual_counts, value_edges, value_edges),
+        'residual_vs_predicted': (residual_counts, value_edges, residual_edges),
+        'n_predictions': n_predictions,
+        'n_out_of_range': n_out_of_range,
+    }
+
+
+def plot_predictions_vs_real_values_from_batches(
+    batches, value_range, residual_range=None, bins=100,
+    show_actual=True, show_residual=True,
+):
+    """ Same plots as 'plot_predictions_vs_real_values', drawn as 2D
+    histograms (log color scale) accumulated over (y_true, y_pred) batches.
+    Suited to millions of predictions streamed from a generator.
+
+    See 'accumulate_prediction_error_histograms' for the parameters."""
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+    histograms = accumulate_prediction_error_histograms(
+        batches, value_range, residual_range=residual_range, bins=bins
+    )
+    if histograms['n_out_of_range'] > 0:
+        print(f"{histograms['n_out_of_range']} predictions out of "
+              f"{histograms['n_predictions']} are out of the ranges and "
+              "are not displayed.")
+
+    plots = []
+    if show_actual:
+        plots.append(('actual_vs_predicted', 'Actual values',
+                      "Predictions vs real values on the test set"))
+    if show_residual:
+        plots.append(('residual_vs_predicted', 'Residuals (actual - predicted)',
+                      "Residual vs real values on the test set"))
+    low, high = value_range
+    for kind, ylabel, title in plots:
+        counts, x_edges, y_edges = histograms[kind]
+        _, ax = plt.subplots(figsize=(6, 5))
+        mesh = ax.pcolormesh(x_edges, y_edges,
+                             np.ma.masked_equal(counts.T, 0),
+                             norm=LogNorm(), cmap='viridis')
+        plt.colorbar(mesh, ax=ax, label='Number of predictions')
+        if kind == 'actual_vs_predicted':
+            ax.plot([low, high], [low, high], color='black', ls='--')
+        else:
+            ax.plot([low, high], [0, 0], color='black', ls='--')
+        ax.set_xlabel('Predicted values')
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+        plt.show()
+    return None
+
+
 def xgb_cv(
     alg, X_train, y_train,
     metric='rmse',
     cv_folds=5,
     early_stopping_rounds=10,
-    verbose=True
+    verbose=True,
+    dtrain=None,
 ):
     """ Compute CV in order to find the right number of estimators before 
     it over-fits. 
     
     Returns a dataframe with scores' mean and std.
     
-    The shape[0] of the dataframe is the optimal number of trees"""
+    The shape[0] of the dataframe is the optimal number of trees.
+    
+    dtrain : a xgb.DMatrix of (X_train, y_train) built once by the caller
+    to be reused between calls. X_train and y_train are then ignored."""
+    import xgboost as xgb
     xgb_param = alg.get_xgb_params()
-    xgb_data = xgb.DMatrix(X_train, y_train)
+    if dtrain is None:
+        dtrain = xgb.DMatrix(X_train, y_train)
     cv_result = xgb.cv(
         xgb_param,
-        xgb_data,
+        dtrain,
         num_boost_round=alg.get_params()['n_estimators'],
         nfold=cv_folds,
         verbose_eval=verbose,
@@ -531,29 +783,92 @@ def xgb_cv(
     return cv_result
 
 def optimize_estimators_number(
-    alg: xgb.Booster,
+    alg: 'xgb.Booster',
     X_train: pd.DataFrame,
     y_train: pd.DataFrame,
     metric='rmse',
     cv_folds=5,
     early_stopping_rounds=10,
-    verbose=True
+    verbose=True,
+    dtrain=None,
 ):
     """ Compute a cross-validation to find the optimal number of estimators
     to use for a certain booster configuration and set it to that number. 
     
+    dtrain : see 'xgb_cv'.
+    
     Return the optimized booster."""
     cv_result = xgb_cv(
         alg, X_train, y_train,
         metric=metric, cv_folds=cv_folds, 
         early_stopping_rounds=early_stopping_rounds,
-        verbose=verbose
+        verbose=verbose,
+        dtrain=dtrain,
     )
     if verbose:
         display(cv_result.tail(10))
 
     return alg.set_params(n_estimators=cv_result.shape[0])
 
+
+def xgb_tune_boost_rounds(
+    X_train, y_train, params_grid,
+    base_params=None,
+    num_boost_round=1000,
+    metric='rmse',
+    cv_folds=5,
+    early_stopping_rounds=10,
+    nthread=None,
+    seed=0,
+):
+    """ For each booster configuration of 'params_grid', compute a
+    cross-validation to find its optimal number of boosting rounds.
+
+    The DMatrix is built only once and reused by all configurations, which
+    use the 'hist' tree method. All configurations are evaluated on the
+    same folds ('seed').
+
+    params_grid : a dict of lists (expanded with sklearn ParameterGrid) or a
+        list of parameters dictionaries, e.g. {'max_depth': [3, 5, 7],
+        'learning_rate': [0.05, 0.1]}.
+    base_params : booster parameters shared by all configurations, e.g.
+        {'objective': 'reg:squarederror'}.
+    nthread : number of threads of xgboost (all cores by default).
+
+    Return a dataframe with one row per configuration : its parameters,
+    the optimal number of rounds ('n_estimators') and the test score mean
+    and std at that round."""
+    import xgboost as xgb
+    from sklearn.model_selection import ParameterGrid
+    if isinstance(params_grid, dict):
+        params_grid = ParameterGrid(params_grid)
+    shared_params = {**(base_params or {}), 'tree_method': 'hist'}
+    if nthread is not None:
+        shared_params['nthread'] = nthread
+
+    dtrain = xgb.DMatrix(X_train, y_train,
+                         nthread=-1 if nthread is None else nthread)
+    rows = []
+    for params in params_grid:
+        cv_result = xgb.cv(
+            {**shared_params, **params},
+            dtrain,
+            num_boost_round=num_boost_round,
+            nfold=cv_folds,
+            metrics=metric,
+            early_stopping_rounds=early_stopping_rounds,
+            seed=seed,
+            verbose_eval=False,
+        )
+        best_round = cv_result.iloc[-1]
+        rows.append({
+            **params,
+            'n_estimators': cv_result.shape[0],
+            f'test_{metric}_mean': best_round[f'test-{metric}-mean'],
+            f'test_{metric}_std': best_round[f'test-{metric}-std'],
+        })
+    return pd.DataFrame(rows)
+
 ### QUERY
 def or_query_instruction(feature_name: str, values: list) -> str:
     """ Creates a query instruction when searching for multiple 'values'
@@ -563,8 +878,28 @@ def or_query_instruction(feature_name: str, values: list) -> str:
         query_instruction += (feature_name + ' == "' + val + '" | ')
     return query_instruction[:-3]
 
+
+def or_filter_mask(data, feature_name: str, values: list) -> pd.Series:
+    """ Boolean mask of the rows where 'feature_name' is one of 'values'.
+    
+    Same inputs as 'or_query_instruction', but no query string is built
+    and parsed : a single vectorized lookup is made on the categorical
+    codes (or in a hash table for the other dtypes). The mask can be
+    combined with other conditions, e.g.
+    data.loc[or_filter_mask(data, 'category', cats) & (data.price > 100)]
+    """
+    column = data[feature_name]
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        wanted_codes = column.cat.categories.get_indexer(list(values))
+        wanted_codes = wanted_codes[wanted_codes >= 0]
+        return pd.Series(np.isin(column.cat.codes.to_numpy(), wanted_codes),
+                         index=data.index, name=feature_name)
+    return column.isin(values)
+
 ###
 def my_pairplot(data):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     g = sns.PairGrid(data)
     g.map_upper(sns.histplot)
     g.map_lower(sns.kdeplot, fill=True)
@@ -573,11 +908,32 @@ def my_pairplot(data):
     
     
 ### Clustering
-pal = sns.color_palette(cc.glasbey, n_colors=25)
+@lru_cache(maxsize=None)
+def glasbey_palette(n_colors=25):
+    """ Return the default palette of the clustering displays, built only
+    once on first use. """
+    import seaborn as sns
+    import colorcet as cc
+    return sns.color_palette(cc.glasbey, n_colors=n_colors)
+
+
+def __getattr__(name):
+    # Keep 'pal' available as a module attribute without building it at
+    # import time.
+    if name == 'pal':
+        return glasbey_palette()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def plot_dendrogram(model, **kwargs):
-    """ Create linkage matrix and then plot the dendrogram """
+    """ Create linkage matrix and then plot the dendrogram.
+    
+    'model' is a fitted AgglomerativeClustering, or directly a scipy
+    linkage matrix (e.g. from 'birch_hierarchical_clustering')."""
+    from scipy.cluster.hierarchy import dendrogram
+    if isinstance(model, np.ndarray):
+        dendrogram(model, **kwargs)
+        return None
     # create the counts of samples under each node
     counts = np.zeros(model.children_.shape[0])
     n_samples = len(model.labels_)
@@ -628,7 +984,7 @@ def add_centroids_display_in_a_plan(centroids, ax, selected_coordinates):
 
 
 def display_clusters_in_pca_space_and_tsne_embedding(
-    X_proj, pca, X_tsne, label_vec, label_name, palette=pal,
+    X_proj, pca, X_tsne, label_vec, label_name, palette=None,
     centroids=None
 ):
     """ 
@@ -639,6 +995,9 @@ def display_clusters_in_pca_space_and_tsne_embedding(
     X_proj and X_tsne are ndarrays of the same length.
     
     """
+    import matplotlib.pyplot as plt
+    if palette is None:
+        palette = glasbey_palette()
     if centroids is not None:
         pca_centroids = pca.transform(centroids)
     
@@ -687,23 +1046,82 @@ def display_clusters_in_pca_space_and_tsne_embedding(
     return None
 
 
-def display_clusters_summary_table(X, label_name):
-    """ X is a dataframe with all the features and a label_name column. """
-    table = (X.groupby(label_name)
-            .agg(['mean', 'std', 'min', 'max'])
-            .T)
-    display(table.style.pipe(cluster_table_prettier))
+def cluster_profile(X, label_name, percentiles=(1, 25, 50, 75, 99)):
+    """ Compute once the statistics of each feature per cluster :
+    count, mean, std, min, max and percentiles (columns 'p1', 'p25', ...).
+    The clusters' effectives are stored in the (label_name, 'size') column.
+
+    The result can be passed as 'profile' to the clusters display
+    functions, so that they do not scan the data again.
+
+    X is a dataframe with all the features and a label_name column. """
+    grouped = X.groupby(label_name)
+    features = [ft for ft in X.columns if ft != label_name]
+    stats = grouped.agg(['count', 'mean', 'std', 'min', 'max'])
+    quantiles = (grouped
+                 .quantile([p / 100 for p in percentiles])
+                 .unstack())
+    quantiles.columns = pd.MultiIndex.from_tuples(
+        [(ft, f'p{round(q * 100)}') for ft, q in quantiles.columns]
+    )
+    stat_names = ['count', 'mean', 'std', 'min', 'max',
+                  *[f'p{p}' for p in percentiles]]
+    profile = pd.concat([stats, quantiles], axis=1).loc[
+        :, [(ft, stat) for ft in features for stat in stat_names]
+    ]
+    profile.insert(0, (label_name, 'size'), grouped.size())
+    return profile
+
+
+def _profile_features(profile, label_name):
+    return [ft for ft in profile.columns.get_level_values(0).unique()
+            if ft != label_name]
+
+
+def display_clusters_summary_table(X, label_name, profile=None, show=True):
+    """ X is a dataframe with all the features and a label_name column.
+    
+    When the 'profile' of 'cluster_profile' is provided, X is not used.
+    When show is False, return the styled table instead of displaying it."""
+    if profile is None:
+        table = (X.groupby(label_name)
+                .agg(['mean', 'std', 'min', 'max'])
+                .T)
+    else:
+        features = _profile_features(profile, label_name)
+        table = profile.loc[
+            :, [(ft, stat) for ft in features
+                for stat in ['mean', 'std', 'min', 'max']]
+        ].T
+    styled_table = table.style.pipe(cluster_table_prettier)
+    if not show:
+        return styled_table
+    display(styled_table)
     return None
 
 
 def display_features_boxplot_per_cluster(
     X, label_name, layout=(1, 3),
-    showfliers=False, palette=pal
+    showfliers=False, palette=None, profile=None, show=True
 ):
-    """ X is a dataframe with all the features and a label_name column. """
+    """ X is a dataframe with all the features and a label_name column.
+    
+    When the 'profile' of 'cluster_profile' is provided, X is not used
+    and boxes are drawn from the precomputed percentiles (no fliers).
+    When show is False, return the figure instead of displaying it."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    if palette is None:
+        palette = glasbey_palette()
+    if profile is None:
+        features = X.columns
+        n_clusters = X[label_name].nunique()
+    else:
+        features = _profile_features(profile, label_name)
+        n_clusters = len(profile)
     # fig structure
     n_rows, n_cols = layout
-    height = max(3, X[label_name].nunique()/3)
+    height = max(3, n_clusters/3)
     fig, axs = plt.subplots(nrows=n_rows, ncols=n_cols,
                             figsize=(n_cols * 5, n_rows * height))
     # fliers props
@@ -711,29 +1129,69 @@ def display_features_boxplot_per_cluster(
                       markersize=8,
                       alpha=0.1,)
     
-    for ax, ft in zip(axs.flat, X.columns):
-        sns.boxplot(y=label_name, x=ft, data=X,
-                    ax=ax, showfliers=showfliers, orient='h',
-                    whis=[1,99],
-                    flierprops=flierprops,
-                    palette=palette,
-                    width=0.4)
+    for ax, ft in zip(axs.flat, features):
+        if profile is None:
+            sns.boxplot(y=label_name, x=ft, data=X,
+                        ax=ax, showfliers=showfliers, orient='h',
+                        whis=[1,99],
+                        flierprops=flierprops,
+                        palette=palette,
+                        width=0.4)
+        else:
+            ft_profile = profile[ft]
+            stats = [
+                {'label': label,
+                 'whislo': row.p1, 'q1': row.p25, 'med': row.p50,
+                 'q3': row.p75, 'whishi': row.p99}
+                for label, row in ft_profile.iterrows()
+            ]
+            boxes = ax.bxp(stats, vert=False, showfliers=False,
+                           patch_artist=True, widths=0.4,
+                           medianprops={'color': 'black'})
+            for box, color in zip(boxes['boxes'], palette):
+                box.set_facecolor(color)
+            # Same order as seaborn : first cluster on top
+            ax.invert_yaxis()
+            ax.set_xlabel(ft)
+            ax.set_ylabel(label_name)
         ax.xaxis.label.set_size(16)
     plt.suptitle(f'{label_name} : whisker percentiles (1 ; 99)', y=1.01)
     plt.tight_layout()
+    if not show:
+        return fig
     plt.show()
     return None
     
     
-def display_clusters_effectives_and_percentages(X, label_name, palette=pal):
-    """ X is a dataframe with all the features and a label_name column. """
+def display_clusters_effectives_and_percentages(
+    X, label_name, palette=None, profile=None, show=True
+):
+    """ X is a dataframe with all the features and a label_name column.
+    
+    When the 'profile' of 'cluster_profile' is provided, X is not used.
+    When show is False, return the figure instead of displaying it."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    if palette is None:
+        palette = glasbey_palette()
     width = 0.3
-    ysize = max(X[label_name].nunique() / 2, 3)
+    if profile is None:
+        n_clusters = X[label_name].nunique()
+        total = len(X)
+    else:
+        effectives = profile[(label_name, 'size')]
+        n_clusters = len(effectives)
+        total = effectives.sum()
+    ysize = max(n_clusters / 2, 3)
     fig, ax = plt.subplots(figsize=(5, ysize))
-    sns.countplot(data=X, y=label_name,
-                  palette=palette,
-                  ax=ax, width=width)    
-    total = len(X)
+    if profile is None:
+        sns.countplot(data=X, y=label_name,
+                      palette=palette,
+                      ax=ax, width=width)
+    else:
+        ax.barh([str(label) for label in effectives.index], effectives,
+                color=palette[:n_clusters], height=width)
+        ax.invert_yaxis()
     xs = []
     ys = []
     pcts = []
@@ -755,12 +1213,14 @@ def display_clusters_effectives_and_percentages(X, label_name, palette=pal):
     ax.set_xlabel('')
     plt.title("Clusters' effectives", fontsize=18)
     plt.tight_layout()
+    if not show:
+        return fig
     plt.show()
     return None
     
     
 def display_clusters_comparison(
-    X, label_name, layout=(1,3), showfliers=False,
+    X, label_name, layout=(1,3), showfliers=False, aggregated=False,
 ):
     """ For each feature of X :
         1) Plot a table summing the information of clusters.
@@ -771,22 +1231,796 @@ def display_clusters_comparison(
         X (pd.DataFrame): Dataframe restricted to the features of
         interest plus the label column.
         label_name (str): the label column name.
+        aggregated (bool): compute the clusters' statistics once with
+        'cluster_profile' and draw the 3 displays from them. Much faster
+        on large tables, but fliers are not displayed.
 
     Returns:
         None
     """
+    profile = cluster_profile(X, label_name) if aggregated else None
+
     # The summary table 
-    display_clusters_summary_table(X, label_name)
+    display_clusters_summary_table(X, label_name, profile=profile)
     
     # Boxplots  
     display_features_boxplot_per_cluster(X, label_name,
                                          layout=layout, 
-                                         showfliers=showfliers)
+                                         showfliers=showfliers,
+                                         profile=profile)
     
     # The effectives
-    display_clusters_effectives_and_percentages(X, label_name)
+    display_clusters_effectives_and_percentages(X, label_name,
+                                                profile=profile)
+    return None
+
+### Headless reports
+def _inputs_hash(*objects):
+    """ Hash of the inputs of a report item. Pandas objects are hashed on
+    their values, index and columns, the other objects on their pickle. """
+    h = hashlib.sha1()
+    for obj in objects:
+        if isinstance(obj, pd.DataFrame):
+            h.update(_data_fingerprint(obj).encode())
+        elif isinstance(obj, pd.Series):
+            h.update(pd.util.hash_pandas_object(obj, index=True).values)
+            h.update(repr(obj.name).encode())
+        else:
+            h.update(pickle.dumps(obj))
+    return h.hexdigest()
+
+
+def _render_report_figure(func_name, args, kwargs, path):
+    """ Draw a figure with one of the display functions of this module
+    using the Agg backend (no display needed), then save it to 'path'. """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig = globals()[func_name](*args, show=False, **kwargs)
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+
+def render_clusters_report(
+    X, label_name, output_dir, pca=None, features_name=None,
+    planes=((0, 1), (1, 2)), layout=(1, 3), report_format='html',
+    n_jobs=None,
+):
+    """ Render the clusters diagnostics into 'output_dir' and gather them
+    in a single 'clusters_report.html' (or '.pdf') report.
+
+    No display is needed : figures are drawn with the Agg backend, in
+    parallel processes. A figure is only redrawn when the hash of its inputs
+    changed since the previous run (hashes are kept in
+    'report_manifest.json').
+
+    X : dataframe with all the features and a label_name column.
+    pca : when provided (with 'features_name'), add the scree plot and the
+        correlation circles of the factorial 'planes'.
+
+    Return the path of the report."""
+    if report_format not in ('html', 'pdf'):
+        raise ValueError("report_format must be 'html' or 'pdf'")
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, 'report_manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    # name : (display function name, args, kwargs)
+    figures = {
+        'features_boxplot_per_cluster': (
+            'display_features_boxplot_per_cluster', (X, label_name),
+            {'layout': layout}
+        ),
+        'clusters_effectives': (
+            'display_clusters_effectives_and_percentages', (X, label_name),
+            {}
+        ),
+    }
+    if pca is not None:
+        figures['scree_plot'] = ('display_scree_plot', (pca,), {})
+        for d1, d2 in planes:
+            if d2 < pca.n_components_:
+                figures[f'correlation_circle_pc{d1 + 1}_pc{d2 + 1}'] = (
+                    'display_correlation_circle', (pca, (d1, d2)),
+                    {'features_name': features_name}
+                )
+
+    def path_of(name, extension='.png'):
+        return os.path.join(output_dir, name + extension)
+
+    # Summary table
+    table_hash = _inputs_hash('display_clusters_summary_table', X, label_name)
+    if (manifest.get('clusters_summary_table') != table_hash
+            or not os.path.exists(path_of('clusters_summary_table', '.pkl'))):
+        table = display_clusters_summary_table(X, label_name, show=False)
+        pd.to_pickle(table.data, path_of('clusters_summary_table', '.pkl'))
+        with open(path_of('clusters_summary_table', '.html'), 'w') as f:
+            f.write(table.to_html())
+        manifest['clusters_summary_table'] = table_hash
+
+    # Figures, only when their inputs changed
+    to_render = {}
+    for name, (func_name, args, kwargs) in figures.items():
+        # Each argument on its own, so that dataframes are hashed on values
+        inputs_hash = _inputs_hash(
+            func_name, *args,
+            *[obj for item in sorted(kwargs.items()) for obj in item]
+        )
+        if (manifest.get(name) != inputs_hash
+                or not os.path.exists(path_of(name))):
+            to_render[name] = (func_name, args, kwargs, inputs_hash)
+    print(f"{len(to_render)} figures to render, "
+          f"{len(figures) - len(to_render)} unchanged.")
+    try:
+        if to_render:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = {
+                    name: executor.submit(_render_report_figure, func_name,
+                                          args, kwargs, path_of(name))
+                    for name, (func_name, args, kwargs, _)
+                    in to_render.items()
+                }
+                for name, future in futures.items():
+                    future.result()
+                    manifest[name] = to_render[name][3]
+    finally:
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    # Gather everything in the report
+    report_path = path_of('clusters_report', '.' + report_format)
+    title = f"Clusters report : {label_name}"
+    if report_format == 'html':
+        with open(path_of('clusters_summary_table', '.html')) as f:
+            sections = [f"<h2>Summary table</h2>\n{f.read()}"]
+        sections += [
+            f'<h2>{name.replace("_", " ").capitalize()}</h2>\n'
+            f'<img src="{name}.png">'
+            for name in figures
+        ]
+        with open(report_path, 'w') as f:
+            f.write(f'<html>\n<head><meta charset="utf-8">'
+                    f'<title>{title}</title></head>\n<body>\n'
+                    f'<h1>{title}</h1>\n' + '\n'.join(sections)
+                    + '\n</body>\n</html>\n')
+    else:
+        # Figures are created without pyplot to leave the backend untouched
+        from matplotlib.figure import Figure
+        from matplotlib.image import imread
+        from matplotlib.backends.backend_pdf import PdfPages
+        table = pd.read_pickle(path_of('clusters_summary_table', '.pkl'))
+        with PdfPages(report_path) as pdf:
+            fig = Figure(figsize=(2 + 1.2 * table.shape[1],
+                                  1 + 0.25 * table.shape[0]))
+            ax = fig.add_axes([0, 0, 1, 1])
+            ax.axis('off')
+            ax.set_title(title)
+            ax.table(cellText=table.round(2).values,
+                     rowLabels=[' '.join(map(str, idx)) for idx in table.index],
+                     colLabels=list(table.columns),
+                     loc='center')
+            pdf.savefig(fig, bbox_inches='tight')
+            for name in figures:
+                image = imread(path_of(name))
+                height, width = image.shape[:2]
+                fig = Figure(figsize=(width / 100, height / 100))
+                ax = fig.add_axes([0, 0, 1, 1])
+                ax.imshow(image)
+                ax.axis('off')
+                pdf.savefig(fig)
+    return report_path
+
+
+### Clustering sweep
+# Algorithm names and their sklearn.cluster class names
+clustering_algorithms = {
+    'kmeans': 'KMeans',
+    'agglomerative': 'AgglomerativeClustering',
+    'dbscan': 'DBSCAN',
+    'optics': 'OPTICS',
+}
+
+
+def clustering_config_name(algorithm, params):
+    """ Return a readable name identifying a configuration,
+    e.g. "kmeans(n_clusters=5, n_init=10)". """
+    params_str = ', '.join(f'{k}={v!r}' for k, v in sorted(params.items()))
+    return f'{algorithm}({params_str})'
+
+
+def clustering_scores(X, labels, silhouette_sample_size=None, seed=0):
+    """ Return a dictionary with the number of clusters, the noise ratio,
+    and the silhouette, Calinski-Harabasz and Davies-Bouldin scores.
+
+    Noise points (label -1 with DBSCAN/OPTICS) are left out of the scores.
+    Scores are NaN when there are less than 2 clusters."""
+    from sklearn.metrics import silhouette_score
+    from sklearn.metrics import calinski_harabasz_score
+    from sklearn.metrics import davies_bouldin_score
+    X = np.asarray(X)
+    labels = np.asarray(labels)
+    clustered = labels != -1
+    n_clusters = len(np.unique(labels[clustered]))
+    scores = {
+        'n_clusters': n_clusters,
+        'noise_ratio': 1 - clustered.mean(),
+        'silhouette': np.nan,
+        'calinski_harabasz': np.nan,
+        'davies_bouldin': np.nan,
+    }
+    if 2 <= n_clusters < clustered.sum():
+        X, labels = X[clustered], labels[clustered]
+        # Silhouette is quadratic in the number of samples
+        if (silhouette_sample_size is not None
+                and silhouette_sample_size >= len(labels)):
+            silhouette_sample_size = None
+        scores['silhouette'] = silhouette_score(
+            X, labels,
+            sample_size=silhouette_sample_size,
+            random_state=seed
+        )
+        scores['calinski_harabasz'] = calinski_harabasz_score(X, labels)
+        scores['davies_bouldin'] = davies_bouldin_score(X, labels)
+    return scores
+
+
+def _data_fingerprint(X):
+    """ Hash of the values, index and columns of a dataframe. """
+    h = hashlib.sha1(pd.util.hash_pandas_object(X, index=True).values)
+    h.update(repr(list(X.columns)).encode())
+    return h.hexdigest()
+
+
+def _clustering_sweep_worker(connection, algorithm, params, X,
+                             silhouette_sample_size, seed):
+    """ Fit and score a configuration in a child process. Send back
+    (result, error) through its own pipe 'connection'. """
+    try:
+        import sklearn.cluster
+        model = getattr(sklearn.cluster,
+                        clustering_algorithms[algorithm])(**params)
+        start = time.perf_counter()
+        labels = model.fit_predict(X)
+        fit_time = time.perf_counter() - start
+        result = clustering_scores(X, labels, silhouette_sample_size, seed)
+        result['fit_time'] = fit_time
+        result['score_time'] = time.perf_counter() - start - fit_time
+        result['labels'] = labels
+        connection.send((result, None))
+    except Exception as e:
+        connection.send((None, repr(e)))
+    connection.close()
+
+
+def clustering_sweep(
+    X, grid, n_jobs=None, timeout=None, cache_dir=None,
+    silhouette_sample_size=10000, seed=0, verbose=True,
+):
+    """ Fit and score every clustering configuration of 'grid' on X.
+
+    X : pre-processed features, e.g. the output of 'clustering_preprocessing'.
+    grid : dict mapping an algorithm name of 'clustering_algorithms' to a
+        list of parameters dictionaries, e.g.
+        {'kmeans': [{'n_clusters': k, 'n_init': 10} for k in range(3, 8)],
+         'dbscan': [{'eps': 0.5, 'min_samples': 20}]}
+    n_jobs : number of fits running simultaneously, each one in its own
+        process (number of cpus by default).
+    timeout : maximum number of seconds per configuration, fit plus
+        scoring (reported as 'fit_time' and 'score_time'). A configuration
+        exceeding it is killed and its scores are left to NaN.
+    cache_dir : when provided, each result is stored in that directory
+        under a key made of the configuration and a hash of X. Following
+        sweeps reload it instead of fitting again.
+    silhouette_sample_size : passed to silhouette_score to bound its
+        quadratic cost on large datasets (None for the exact score on all
+        the points).
+
+    Return (scores, labels) :
+    - scores : one row per configuration with an 'algorithm' column and
+    numerical scores. It can be passed to 'display_clusters_comparison'
+    with label_name='algorithm'.
+    - labels : one column per configuration, indexed as X.
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    X_values = np.asarray(X)
+    fingerprint = _data_fingerprint(X)
+
+    configs = {}
+    for algorithm, params_list in grid.items():
+        if algorithm not in clustering_algorithms:
+            raise ValueError(f"Unknown algorithm '{algorithm}', expected one "
+                             f"of {list(clustering_algorithms)}")
+        for params in params_list:
+            configs[clustering_config_name(algorithm, params)] = (
+                algorithm, params
+            )
+
+    def cache_path(name):
+        key = hashlib.sha1(
+            f'{fingerprint}|{name}|{silhouette_sample_size}|{seed}'.encode()
+        ).hexdigest()
+        return os.path.join(cache_dir, key + '.pkl')
+
+    # Reload what has already been computed
+    results = {}
+    pending = []
+    for name in configs:
+        if cache_dir is not None and os.path.exists(cache_path(name)):
+            try:
+                with open(cache_path(name), 'rb') as f:
+                    results[name] = pickle.load(f)
+                continue
+            except (EOFError, pickle.UnpicklingError):
+                # Truncated file, fitted again
+                pass
+        pending.append(name)
+    if verbose:
+        print(f"{len(results)} configurations loaded from cache, "
+              f"{len(pending)} to fit.")
+
+    # Fit the others, at most n_jobs at a time. Each worker sends its
+    # result through its own pipe : killing one can't affect the others.
+    ctx = multiprocessing.get_context()
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                name = pending.pop(0)
+                algorithm, params = configs[name]
+                receiver, sender = ctx.Pipe(duplex=False)
+                process = ctx.Process(
+                    target=_clustering_sweep_worker,
+                    args=(sender, algorithm, params, X_values,
+                          silhouette_sample_size, seed),
+                )
+                process.start()
+                # Only the worker keeps the sending end : the pipe ends
+                # when it exits.
+                sender.close()
+                running[name] = (process, receiver, time.perf_counter())
+
+            receivers = {receiver: name
+                         for name, (_, receiver, _) in running.items()}
+            for receiver in multiprocessing.connection.wait(list(receivers),
+                                                            timeout=0.1):
+                name = receivers[receiver]
+                process, _, _ = running.pop(name)
+                try:
+                    result, error = receiver.recv()
+                except EOFError:
+                    process.join()
+                    print(f"{name} crashed (exit code {process.exitcode})")
+                    continue
+                finally:
+                    receiver.close()
+                process.join()
+                if error is not None:
+                    print(f"{name} failed : {error}")
+                    continue
+                results[name] = result
+                if cache_dir is not None:
+                    # Write then rename, not to leave a truncated cache file
+                    with open(cache_path(name) + '.tmp', 'wb') as f:
+                        pickle.dump(result, f)
+                    os.replace(cache_path(name) + '.tmp', cache_path(name))
+                if verbose:
+                    print(f"{name} fit in {result['fit_time']:.1f}s, "
+                          f"scored in {result['score_time']:.1f}s")
+
+            for name, (process, receiver, start) in list(running.items()):
+                if (timeout is not None
+                        and time.perf_counter() - start > timeout):
+                    process.terminate()
+                    process.join()
+                    receiver.close()
+                    del running[name]
+                    print(f"{name} killed after {timeout}s")
+    finally:
+        for process, receiver, _ in running.values():
+            process.terminate()
+            process.join()
+            receiver.close()
+
+    # Gather results in the order of the grid
+    score_names = ['n_clusters', 'noise_ratio', 'silhouette',
+                   'calinski_harabasz', 'davies_bouldin', 'fit_time',
+                   'score_time']
+    scores = pd.DataFrame(
+        [
+            {'algorithm': algorithm,
+             **{s: results.get(name, {}).get(s, np.nan) for s in score_names}}
+            for name, (algorithm, _) in configs.items()
+        ],
+        index=pd.Index(list(configs), name='configuration'),
+    )
+    labels = pd.DataFrame(
+        {name: results[name]['labels'] for name in configs if name in results},
+        index=X.index,
+    )
+    return scores, labels
+
+
+### Density clustering
+def knn_graph(X, n_neighbors=20, algorithm='kd_tree', n_jobs=None,
+              max_memory_mb=None, chunk_size=10000):
+    """ Compute once the k-nearest-neighbours graph of X (each point being
+    its own first neighbour) with a tree index, to be reused by
+    'suggest_eps', 'dbscan_from_knn_graph', 'optics_from_knn_graph' and
+    'density_clustering_sweep'.
+
+    Queries are made by chunks of 'chunk_size' points, each one in
+    parallel over 'n_jobs'. The graph takes n_samples * n_neighbors * 16
+    bytes : a ValueError is raised beyond 'max_memory_mb'.
+
+    Return (distances, indices), arrays of shape (n_samples, n_neighbors)
+    sorted by increasing distance."""
+    from sklearn.neighbors import NearestNeighbors
+    X = np.asarray(X, dtype=float)
+    n_neighbors = min(n_neighbors, len(X))
+    graph_mb = len(X) * n_neighbors * 16 / 2**20
+    if max_memory_mb is not None and graph_mb > max_memory_mb:
+        raise ValueError(f"The {n_neighbors}-neighbours graph needs "
+                         f"{graph_mb:.0f}MB > max_memory_mb={max_memory_mb}, "
+                         "reduce n_neighbors.")
+    nn = NearestNeighbors(n_neighbors=n_neighbors, algorithm=algorithm,
+                          n_jobs=n_jobs).fit(X)
+    distances = np.empty((len(X), n_neighbors))
+    indices = np.empty((len(X), n_neighbors), dtype=np.int64)
+    for start in range(0, len(X), chunk_size):
+        stop = start + chunk_size
+        distances[start:stop], indices[start:stop] = nn.kneighbors(
+            X[start:stop])
+    return distances, indices
+
+
+def k_distances(distances, min_samples):
+    """ Sorted distances of each point to its 'min_samples'-th neighbour
+    (itself included, as counted by DBSCAN)."""
+    if min_samples > distances.shape[1]:
+        raise ValueError(f"min_samples={min_samples} needs a graph with at "
+                         f"least {min_samples} neighbours, got "
+                         f"{distances.shape[1]}.")
+    return np.sort(distances[:, min_samples - 1])
+
+
+def suggest_eps(distances, min_samples):
+    """ Suggest a DBSCAN 'eps' for 'min_samples' : the knee of the sorted
+    k-distances curve, i.e. its point the furthest below the chord
+    joining its ends (both axes scaled to [0, 1])."""
+    kd = k_distances(distances, min_samples)
+    if kd[-1] == kd[0]:
+        return kd[0]
+    x = np.linspace(0, 1, len(kd))
+    y = (kd - kd[0]) / (kd[-1] - kd[0])
+    return kd[np.argmax(x - y)]
+
+
+def display_k_distance_plot(distances, min_samples_values=(5, 10, 20),
+                            show=True):
+    """ Plot the sorted k-distances curves and their suggested eps for
+    each of 'min_samples_values'. """
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for min_samples in min_samples_values:
+        kd = k_distances(distances, min_samples)
+        line, = ax.plot(kd, label=f'min_samples={min_samples}')
+        ax.axhline(suggest_eps(distances, min_samples), ls='--', lw=0.8,
+                   color=line.get_color())
+    ax.set_xlabel('Points sorted by k-distance')
+    ax.set_ylabel('k-distance')
+    ax.legend()
+    plt.title('k-distance plot (dashed : suggested eps)', fontsize=14)
+    if not show:
+        return fig
+    plt.show()
     return None
 
+
+def _eps_graph(distances, indices, eps):
+    """ Sparse precomputed distances matrix keeping the graph edges
+    shorter than eps, made symmetric (an edge of i's neighbourhood is added
+    to j's one) which recovers most of the truncated neighbourhoods.
+
+    Zero distances (duplicated points) are kept as explicit entries."""
+    from scipy.sparse import csr_matrix
+    n_samples = len(distances)
+    keep = distances <= eps
+    rows = np.repeat(np.arange(n_samples), keep.sum(axis=1))
+    cols = indices[keep]
+    rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+    data = np.concatenate([distances[keep], distances[keep]])
+    # Edges in both neighbourhoods are kept once, in rows order
+    _, edges = np.unique(rows * n_samples + cols, return_index=True)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows[edges],
+                                                        minlength=n_samples))])
+    return csr_matrix((data[edges], cols[edges], indptr),
+                      shape=(n_samples, n_samples))
+
+
+def dbscan_from_knn_graph(distances, indices, eps, min_samples, n_jobs=None):
+    """ Run DBSCAN on the graph of 'knn_graph' (no neighbours search).
+
+    Core points are exact as long as min_samples <= n_neighbors. The
+    neighbourhood of a point whose n_neighbors-th neighbour is within eps
+    is truncated (only partly recovered by the symmetric graph), which may
+    split clusters or leave border points as noise : see
+    'truncated_ratio' in 'density_clustering_sweep' and increase
+    n_neighbors if it is not small."""
+    from sklearn.cluster import DBSCAN
+    k_distances(distances, min_samples)  # checks min_samples
+    return DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed',
+                  n_jobs=n_jobs).fit_predict(_eps_graph(distances, indices,
+                                                        eps))
+
+
+def optics_from_knn_graph(distances, indices, min_samples, n_jobs=None,
+                          **kwargs):
+    """ Run OPTICS on the graph of 'knn_graph' (no neighbours search) :
+    reachabilities only follow the graph edges, so max_eps is bounded by
+    the longest one. kwargs are passed to OPTICS (xi, cluster_method...)."""
+    from sklearn.cluster import OPTICS
+    k_distances(distances, min_samples)  # checks min_samples
+    max_eps = distances.max()
+    return OPTICS(min_samples=min_samples, max_eps=max_eps,
+                  metric='precomputed', n_jobs=n_jobs,
+                  **kwargs).fit_predict(_eps_graph(distances, indices,
+                                                   max_eps))
+
+
+def density_clustering_sweep(
+    X, grid, n_neighbors=None, algorithm='kd_tree', n_jobs=None,
+    max_memory_mb=None, silhouette_sample_size=10000, seed=0, verbose=True,
+):
+    """ Fit and score DBSCAN / OPTICS configurations on X, computing the
+    nearest neighbours once ('knn_graph') for all of them.
+
+    grid : e.g. {'dbscan': [{'eps': 'auto', 'min_samples': 10},
+                            {'eps': 0.8, 'min_samples': 20}],
+                 'optics': [{'min_samples': 20, 'xi': 0.05}]}
+        eps='auto' uses 'suggest_eps'.
+    n_neighbors : size of the graph, at least the largest min_samples
+        (default : max(20, 2 * largest min_samples)).
+
+    Return (scores, labels) as 'clustering_sweep', scores having the
+    resolved 'eps' and the 'truncated_ratio' of DBSCAN (share of points
+    whose neighbourhood is cut by the graph, see 'dbscan_from_knn_graph').
+    """
+    unknown = set(grid) - {'dbscan', 'optics'}
+    if unknown:
+        raise ValueError(f"Unknown algorithms {unknown}, expected 'dbscan' "
+                         "or 'optics'")
+    max_min_samples = max(params['min_samples']
+                          for params_list in grid.values()
+                          for params in params_list)
+    if n_neighbors is None:
+        n_neighbors = max(20, 2 * max_min_samples)
+
+    start = time.perf_counter()
+    distances, indices = knn_graph(X, n_neighbors, algorithm=algorithm,
+                                   n_jobs=n_jobs, max_memory_mb=max_memory_mb)
+    if verbose:
+        print(f"{n_neighbors}-neighbours graph computed in "
+              f"{time.perf_counter() - start:.1f}s")
+
+    rows, labels = {}, {}
+    for algorithm_name, params_list in grid.items():
+        for params in params_list:
+            params = dict(params)
+            start = time.perf_counter()
+            if algorithm_name == 'dbscan':
+                if params['eps'] == 'auto':
+                    params['eps'] = float(suggest_eps(distances,
+                                                      params['min_samples']))
+                name = clustering_config_name(algorithm_name, params)
+                config_labels = dbscan_from_knn_graph(
+                    distances, indices, n_jobs=n_jobs, **params)
+                truncated_ratio = (distances[:, -1] <= params['eps']).mean()
+                eps = params['eps']
+            else:
+                name = clustering_config_name(algorithm_name, params)
+                config_labels = optics_from_knn_graph(
+                    distances, indices, n_jobs=n_jobs, **params)
+                truncated_ratio = eps = np.nan
+            fit_time = time.perf_counter() - start
+            rows[name] = {
+                'algorithm': algorithm_name,
+                **clustering_scores(X, config_labels,
+                                    silhouette_sample_size, seed),
+                'fit_time': fit_time,
+                'score_time': time.perf_counter() - start - fit_time,
+                'eps': eps,
+                'truncated_ratio': truncated_ratio,
+            }
+            labels[name] = config_labels
+            if verbose:
+                print(f"{name} fit in {fit_time:.1f}s, scored in "
+                      f"{rows[name]['score_time']:.1f}s")
+
+    scores = pd.DataFrame.from_dict(rows, orient='index')
+    scores.index.name = 'configuration'
+    return scores, pd.DataFrame(labels, index=X.index)
+
+### Two-stage hierarchical clustering
+def birch_micro_clusters(X, threshold=0.5, branching_factor=50,
+                         chunk_size=10000):
+    """ Compress X into micro-clusters with a BIRCH CF-tree, streamed by
+    chunks of 'chunk_size' rows (Birch.partial_fit).
+
+    Each point is then assigned to its closest subcluster, and the
+    micro-clusters are the non-empty subclusters with the mean of their
+    points as centroid.
+
+    Return (centroids, weights, micro_labels) : the centroids and number
+    of points of the micro-clusters, and the micro-cluster of each point."""
+    from sklearn.cluster import Birch
+    X = np.asarray(X, dtype=float)
+    birch = Birch(threshold=threshold, branching_factor=branching_factor,
+                  n_clusters=None)
+    for start in range(0, len(X), chunk_size):
+        birch.partial_fit(X[start:start + chunk_size])
+    micro_labels = np.concatenate([
+        birch.predict(X[start:start + chunk_size])
+        for start in range(0, len(X), chunk_size)
+    ])
+    # Drop the subclusters no point is the closest to
+    used, micro_labels = np.unique(micro_labels, return_inverse=True)
+    weights = np.bincount(micro_labels)
+    centroids = np.zeros((len(used), X.shape[1]))
+    np.add.at(centroids, micro_labels, X)
+    centroids /= weights[:, None]
+    return centroids, weights, micro_labels
+
+
+def weighted_ward_linkage(centroids, weights):
+    """ Ward agglomerative clustering of points with weights (e.g.
+    micro-clusters centroids and sizes), with the nearest-neighbour chain
+    algorithm : O(n_points**2) time and O(n_points) memory.
+
+    Merging A and B costs wA * wB / (wA + wB) * ||cA - cB||**2 ; as in
+    scipy, the merge height is sqrt(2 * cost), so unit weights give the
+    same linkage matrix as scipy's 'ward'.
+
+    Return the scipy linkage matrix (counts being, as scipy requires,
+    numbers of weighted points, not of weights).
+    """
+    centroids = np.array(centroids, dtype=float)
+    weights = np.array(weights, dtype=float)
+    n_points = len(centroids)
+    active = np.ones(n_points, dtype=bool)
+    node_ids = np.arange(n_points)
+    counts = np.ones(n_points)
+    merges = []
+    chain = []
+    while len(merges) < n_points - 1:
+        if not chain:
+            chain.append(np.flatnonzero(active)[0])
+        a = chain[-1]
+        costs = (weights[a] * weights / (weights[a] + weights)
+                 * ((centroids - centroids[a]) ** 2).sum(axis=1))
+        costs[~active] = np.inf
+        costs[a] = np.inf
+        b = np.argmin(costs)
+        # Prefer the previous element of the chain on ties
+        if len(chain) > 1 and costs[chain[-2]] <= costs[b]:
+            b = chain[-2]
+        if len(chain) > 1 and b == chain[-2]:
+            chain = chain[:-2]
+            merged_weight = weights[a] + weights[b]
+            counts[a] += counts[b]
+            merges.append([node_ids[a], node_ids[b],
+                           np.sqrt(2 * costs[b]), counts[a]])
+            centroids[a] = (weights[a] * centroids[a]
+                            + weights[b] * centroids[b]) / merged_weight
+            weights[a] = merged_weight
+            active[b] = False
+            node_ids[a] = n_points + len(merges) - 1
+        else:
+            chain.append(b)
+
+    # Sort the merges by height and renumber the merged nodes accordingly
+    merges = np.array(merges).reshape(-1, 4)
+    order = np.argsort(merges[:, 2], kind='stable')
+    new_ids = np.arange(2 * n_points - 1)
+    new_ids[n_points + order] = n_points + np.arange(len(order))
+    linkage_matrix = merges[order]
+    linkage_matrix[:, :2] = new_ids[linkage_matrix[:, :2].astype(int)]
+    # scipy expects the smallest cluster index first
+    linkage_matrix[:, :2].sort(axis=1)
+    return linkage_matrix
+
+
+def birch_hierarchical_clustering(
+    X, n_clusters, threshold=0.5, branching_factor=50, chunk_size=10000,
+):
+    """ Hierarchical (Ward) segmentation of large datasets in two stages :
+    X is compressed into micro-clusters ('birch_micro_clusters', a few
+    thousand is a good target : increase 'threshold' to get less), which
+    are clustered with a Ward linkage weighted by their sizes
+    ('weighted_ward_linkage'). The tree is cut in 'n_clusters' and the
+    labels are mapped back to the points of X.
+
+    Return (labels, linkage_matrix, micro_labels) :
+    - labels : cluster (from 0) of each point of X, e.g. for
+    display_clusters_comparison(X.assign(cluster=labels), 'cluster',
+    aggregated=True),
+    - linkage_matrix : the tree of the micro-clusters, for 'plot_dendrogram'
+    (e.g. with truncate_mode='lastp'),
+    - micro_labels : the micro-cluster of each point of X (leaves of the
+    tree)."""
+    from scipy.cluster.hierarchy import fcluster
+    centroids, weights, micro_labels = birch_micro_clusters(
+        X, threshold, branching_factor, chunk_size)
+    print(f"{len(X)} points compressed into {len(centroids)} micro-clusters")
+    linkage_matrix = weighted_ward_linkage(centroids, weights)
+    micro_clusters_labels = fcluster(linkage_matrix, n_clusters,
+                                     criterion='maxclust') - 1
+    return micro_clusters_labels[micro_labels], linkage_matrix, micro_labels
+
+### Drift monitoring
+def _binned_proportions(values, inner_edges):
+    """ Proportions of the non-missing values in the bins delimited by
+    'inner_edges' (the outer bins being open-ended)."""
+    values = values[~np.isnan(values)]
+    counts = np.bincount(np.searchsorted(inner_edges, values, side='right'),
+                         minlength=len(inner_edges) + 1)
+    return counts / max(len(values), 1)
+
+
+def make_drift_reference(X_ref, n_bins=10):
+    """ Fix, for each feature of the reference snapshot X_ref (e.g. the
+    output of 'clustering_preprocessing' at the training date), the bins
+    of 'feature_drift' : its n_bins quantiles (less for discrete features),
+    the outer bins going to -inf and +inf. Keep the reference proportions
+    of each bin. """
+    reference = {'edges': {}, 'proportions': {}}
+    for feature in X_ref.columns:
+        values = X_ref[feature].to_numpy(dtype=float)
+        inner_edges = np.unique(np.nanquantile(
+            values, np.linspace(0, 1, n_bins + 1)[1:-1]))
+        reference['edges'][feature] = inner_edges
+        reference['proportions'][feature] = _binned_proportions(values,
+                                                                inner_edges)
+    return reference
+
+
+def feature_drift(reference, X, psi_threshold=0.2, ks_threshold=0.1,
+                  epsilon=1e-4):
+    """ Compare each feature of the snapshot X to the reference of
+    'make_drift_reference', in one histogram pass over X with the
+    reference bins :
+    - psi : population stability index, sum((p - q) * ln(p / q)) over the
+    bins (proportions clipped at 'epsilon'). Common reading : < 0.1 no
+    drift, 0.1 to 0.2 moderate, > 0.2 significant.
+    - ks : Kolmogorov-Smirnov statistic of the binned distributions, i.e.
+    the largest gap between the cumulative proportions at the bins edges
+    (a lower bound of the exact statistic).
+
+    Return (drift, alarm) : the per-feature table with the statistics and
+    their alarms, and whether any feature exceeds one of the thresholds."""
+    rows = {}
+    for feature, inner_edges in reference['edges'].items():
+        p = reference['proportions'][feature]
+        q = _binned_proportions(X[feature].to_numpy(dtype=float), inner_edges)
+        p_clipped, q_clipped = np.clip(p, epsilon, None), np.clip(q, epsilon,
+                                                                  None)
+        psi = np.sum((q_clipped - p_clipped) * np.log(q_clipped / p_clipped))
+        ks = np.abs(np.cumsum(q) - np.cumsum(p)).max()
+        rows[feature] = {'psi': psi,
+                         'ks': ks,
+                         'psi_alarm': psi > psi_threshold,
+                         'ks_alarm': ks > ks_threshold}
+    drift = pd.DataFrame.from_dict(rows, orient='index')
+    drift.index.name = 'feature'
+    alarm = bool(drift.psi_alarm.any() or drift.ks_alarm.any())
+    return drift, alarm
+
 ### helper functions
 def arguments():
         """Returns a tuple containing :
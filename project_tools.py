@@ -29,26 +29,10 @@ def removekey(d, key):
     return r
 
 
-# Had to use the following because locals() seemed not to work with df?
-def arguments():
-        """Returns a tuple containing :
-           - a dictionary of the calling function's
-           named arguments, and ;
-           - a list of calling function's unnamed
-           positional arguments.
-        """
-        from inspect import getargvalues, stack
-        posname, kwname, args = getargvalues(stack()[1][0])[-3:]
-        posargs = args.pop(posname, [])
-        args.update(args.pop(kwname, []))
-        return args, posargs
-    
-
 def merge_and_display(left, right, on=None, how='left', validate=None):
     """ Merge from left and display nulls values and shapes 
     in order to understand what occurs during the merging process."""
-    args, _ = arguments()
-    df = pd.merge(**args)
+    df = pd.merge(left, right, on=on, how=how, validate=validate)
     print(f"shape before merging : {left.shape}")
     print(f"shape of the right df: {right.shape}")
     print(f"shape after merging : {df.shape}")
@@ -219,17 +203,13 @@ def relatives_to_now(orders_summary, now):
         'elapsed_days_since_last_purchase'
     ) 
     """
-    orders_summary['now'] = now
-    orders_summary['days_since_order'] = ((orders_summary.now
-                                           - (orders_summary
-                                              .order_purchase_timestamp))
-                                          .dt.days)
+    days_since_order = (now - orders_summary.order_purchase_timestamp).dt.days
     
     return (
-                len(orders_summary.query("days_since_order <= 365")),
-                len(orders_summary.query("days_since_order <= 90")),
-                len(orders_summary.query("days_since_order <= 30")),
-                orders_summary['days_since_order'].min(),
+                (days_since_order <= 365).sum(),
+                (days_since_order <= 90).sum(),
+                (days_since_order <= 30).sum(),
+                days_since_order.min(),
     )
     
 ### SECOND FEATURE ENGINEERING
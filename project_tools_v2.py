@@ -1,3 +1,6 @@
+import os
+import hashlib
+
 import pandas as pd
 import numpy as np
 from sklearn.preprocessing import StandardScaler
@@ -7,22 +10,103 @@ from sklearn.compose import make_column_transformer
 
 
 ### EDA TOOLS
-def make_summary(datasets):
-    summary = pd.DataFrame({},)
-    summary['dataset_name'] = datasets.keys()
-    summary['columns_names'] = [list(dataset.columns)
-                                for dataset in datasets.values()]
-    summary['rows_num'] = [dataset.shape[0] for dataset in datasets.values()]
-    summary['cols_num'] = [dataset.shape[1] for dataset in datasets.values()]
-    summary['total_duplicates'] = [dataset.duplicated().sum() 
-                                   for dataset in datasets.values()]
-    summary = summary.set_index(['dataset_name'])
+# Profiles already computed, per (dataset fingerprint, duplicates subset)
+_datasets_profiles_cache = {}
+
+
+def dataset_fingerprint(dataset, row_hashes=None):
+    """ Fingerprint of a dataset : its shape, columns, dtypes and the sum
+    of the 64-bit hashes of all its rows ('row_hashes' if already
+    computed), so that any edited value changes it."""
+    if row_hashes is None:
+        row_hashes = pd.util.hash_pandas_object(dataset, index=False)
+    h = hashlib.sha1(repr((dataset.shape,
+                           list(dataset.columns),
+                           list(map(str, dataset.dtypes)),
+                           int(row_hashes.to_numpy().sum()))).encode())
+    return h.hexdigest()
+
+
+def profile_dataset(dataset, subset=None, use_cache=True):
+    """ Return (dataset_summary, columns_profile) :
+    - dataset_summary : pd.Series with the columns names, the numbers of
+    rows, columns and duplicates, the mean null rate and the memory (MB) ;
+    - columns_profile : df with the null rate, the cardinality and the
+    memory (MB) of each column.
+    
+    Duplicates are found from a single 64-bit hash per row, computed on
+    the 'subset' columns (e.g. the key columns) or on all columns.
+    Results are cached per dataset fingerprint (see 'dataset_fingerprint'),
+    computed from the same rows hashes."""
+    row_hashes = pd.util.hash_pandas_object(dataset, index=False)
+    key = (dataset_fingerprint(dataset, row_hashes),
+           None if subset is None else tuple(subset))
+    if use_cache and key in _datasets_profiles_cache:
+        return _datasets_profiles_cache[key]
+    
+    if subset is not None:
+        row_hashes = pd.util.hash_pandas_object(dataset.loc[:, subset],
+                                                index=False)
+    null_rates = dataset.isnull().mean()
+    memory_mb = dataset.memory_usage(deep=True, index=False) / 1e6
+    columns_profile = pd.DataFrame({
+        'null_rate': null_rates,
+        'cardinality': dataset.nunique(),
+        'memory_mb': memory_mb,
+    })
+    dataset_summary = pd.Series({
+        'columns_names': list(dataset.columns),
+        'rows_num': dataset.shape[0],
+        'cols_num': dataset.shape[1],
+        'total_duplicates': row_hashes.duplicated().sum(),
+        'null_rate': null_rates.mean(),
+        'memory_mb': memory_mb.sum(),
+    })
+    _datasets_profiles_cache[key] = (dataset_summary, columns_profile)
+    return dataset_summary, columns_profile
+
+
+def _subset_of(subset, dataset_name):
+    """ 'subset' is either a list of columns for all datasets or a dict
+    of lists per dataset name. """
+    if isinstance(subset, dict):
+        return subset.get(dataset_name)
+    return subset
+
+
+def make_summary(datasets, subset=None, use_cache=True):
+    """ One row per dataset of the 'datasets' dict, see 'profile_dataset'.
+    
+    subset : columns on which duplicates are searched, either a list for
+    all datasets or a dict of lists per dataset name."""
+    summary = pd.DataFrame({
+        name: profile_dataset(dataset, _subset_of(subset, name),
+                              use_cache)[0]
+        for name, dataset in datasets.items()
+    }).T
+    summary.index.name = 'dataset_name'
+    summary = summary.astype({'rows_num': int, 'cols_num': int,
+                              'total_duplicates': int,
+                              'null_rate': float, 'memory_mb': float})
     return summary
 
 
-def display_summary(datasets):
-    summary = make_summary(datasets)
+def make_columns_profile(datasets, use_cache=True):
+    """ Null rate, cardinality and memory (MB) of each column of each
+    dataset of the 'datasets' dict, indexed by (dataset_name, column). """
+    return pd.concat(
+        {name: profile_dataset(dataset, use_cache=use_cache)[1]
+         for name, dataset in datasets.items()},
+        names=['dataset_name', 'column'],
+    )
+
+
+def display_summary(datasets, subset=None, columns_profile=False):
+    summary = make_summary(datasets, subset=subset)
     display(summary.style.background_gradient(cmap='Purples'))
+    if columns_profile:
+        display(make_columns_profile(datasets)
+                .style.background_gradient(cmap='Purples'))
     return None
 
 
@@ -35,32 +119,140 @@ def removekey(d, key):
     return r
 
 
-# Had to use the following because locals() seemed not to work with df?
-def arguments():
-        """Returns a tuple containing :
-           - a dictionary of the calling function's
-           named arguments, and ;
-           - a list of calling function's unnamed
-           positional arguments.
-        """
-        from inspect import getargvalues, stack
-        posname, kwname, args = getargvalues(stack()[1][0])[-3:]
-        posargs = args.pop(posname, [])
-        args.update(args.pop(kwname, []))
-        return args, posargs
+def merge_diagnostics(left, right, merged, on=None, null_rates=False):
+    """ Describe what occurred while merging 'left' and 'right' into
+    'merged'. Return a dictionary with :
+    - 'shapes' : shapes of the left, right and merged dataframes ;
+    - 'fan_out' : per side, the number of distinct keys and the mean and
+    max number of rows per key, plus the rows ratio merged / left ;
+    - 'null_rates' : non-null rate of each merged column, only computed
+    when null_rates is True (None otherwise).
     
+    'on' defaults to the columns shared by left and right, as pd.merge."""
+    if on is None:
+        on = [col for col in left.columns if col in right.columns]
+    rows_per_key = {side: df.groupby(on, dropna=False).size()
+                    for side, df in [('left', left), ('right', right)]}
+    fan_out = pd.DataFrame({
+        'n_keys': {side: len(s) for side, s in rows_per_key.items()},
+        'mean_rows_per_key': {side: s.mean() for side, s in rows_per_key.items()},
+        'max_rows_per_key': {side: s.max() for side, s in rows_per_key.items()},
+    })
+    fan_out['merged_rows_per_left_row'] = len(merged) / len(left)
+    return {
+        'shapes': pd.DataFrame(
+            [left.shape, right.shape, merged.shape],
+            index=['left', 'right', 'merged'], columns=['rows', 'cols'],
+        ),
+        'fan_out': fan_out,
+        'null_rates': merged.notnull().mean() if null_rates else None,
+    }
+
 
-def merge_and_display(left, right, on=None, how='left', validate=None):
+def merge_and_display(left, right, on=None, how='left', validate=None,
+                      null_rates=True, return_diagnostics=False):
     """ Merge from left and display nulls values and shapes 
-    in order to understand what occurs during the merging process."""
-    args, _ = arguments()
-    df = pd.merge(**args)
+    in order to understand what occurs during the merging process.
+    
+    null_rates : compute (and display) the non-null rate of each column.
+    return_diagnostics : return (df, diagnostics) without displaying
+    anything (see 'merge_diagnostics')."""
+    df = pd.merge(left, right, on=on, how=how, validate=validate)
+    diagnostics = merge_diagnostics(left, right, df, on=on,
+                                    null_rates=null_rates)
+    if return_diagnostics:
+        return df, diagnostics
     print(f"shape before merging : {left.shape}")
     print(f"shape of the right df: {right.shape}")
     print(f"shape after merging : {df.shape}")
-    display(df.notnull().mean())
+    display(diagnostics['fan_out'])
+    if null_rates:
+        display(diagnostics['null_rates'])
     return df
 
+def plan_merge(left, right, on=None, how='left', deep=True):
+    """ Predict the number of rows and the memory of
+    pd.merge(left, right, on=on, how=how) without executing it, from the
+    number of rows per key on each side.
+    
+    deep : measure the real memory of object columns (slower).
+    
+    Return a pd.Series with the rows of each side, the predicted rows of
+    the merged df, its ratio to the left rows and its memory in MB."""
+    if on is None:
+        on = [col for col in left.columns if col in right.columns]
+    on = [on] if isinstance(on, str) else list(on)
+    # pd.merge matches null keys together, so they are kept.
+    counts = pd.concat(
+        [left.groupby(on, dropna=False).size().rename('left'),
+         right.groupby(on, dropna=False).size().rename('right')],
+        axis=1,
+    ).fillna(0)
+    matched = counts.left * counts.right
+    left_only = counts.left * (counts.right == 0)
+    right_only = counts.right * (counts.left == 0)
+    if how == 'inner':
+        merged_rows = matched.sum()
+    elif how == 'left':
+        merged_rows = (matched + left_only).sum()
+    elif how == 'right':
+        merged_rows = (matched + right_only).sum()
+    elif how == 'outer':
+        merged_rows = (matched + left_only + right_only).sum()
+    else:
+        raise ValueError("how must be 'inner', 'left', 'right' or 'outer'")
+    
+    # Key columns appear once in the merged df.
+    left_row_bytes = (left.memory_usage(deep=deep, index=False).sum()
+                      / max(len(left), 1))
+    right_row_bytes = (right.drop(columns=on)
+                       .memory_usage(deep=deep, index=False).sum()
+                       / max(len(right), 1))
+    return pd.Series({
+        'left_rows': len(left),
+        'right_rows': len(right),
+        'merged_rows': int(merged_rows),
+        'merged_rows_per_left_row': merged_rows / max(len(left), 1),
+        'merged_memory_mb': (merged_rows
+                             * (left_row_bytes + right_row_bytes) / 1e6),
+    })
+
+
+def aggregate_payments_per_order(payments):
+    """ Return one row per order_id of the payments table : the total
+    payment value, the number of payments, the max number of installments
+    and the value paid per payment type ('payment_value_<type>').
+    
+    Merging it (validate='many_to_one') keeps one row per item instead of
+    one row per item and payment."""
+    per_order = payments.groupby('order_id').agg(
+        payment_value=('payment_value', 'sum'),
+        n_payments=('payment_value', 'size'),
+        payment_installments=('payment_installments', 'max'),
+    )
+    per_type = (payments
+                .pivot_table(index='order_id', columns='payment_type',
+                             values='payment_value', aggfunc='sum',
+                             fill_value=0)
+                .add_prefix('payment_value_'))
+    per_type.columns.name = None
+    return per_order.join(per_type)
+
+
+def aggregate_reviews_per_order(reviews):
+    """ Return one row per order_id of the reviews table : the mean, min
+    and max review scores and the number of reviews.
+    
+    Merging it (validate='many_to_one') keeps one row per item instead of
+    one row per item and review."""
+    return reviews.groupby('order_id').agg(
+        review_score=('review_score', 'mean'),
+        review_score_min=('review_score', 'min'),
+        review_score_max=('review_score', 'max'),
+        n_reviews=('review_score', 'size'),
+    )
+
+
 #### Checking prices consistency
 def order_total_price(grp):
     """ search the price and the freight value of each item and sum it.
@@ -270,6 +462,27 @@ def map_to_main_categories(elem):
 ###########################
 
 # Functions to build the summary of all orders.
+large_product_categories = ['home',
+                            'sports_leisure',
+                            'electronics_and_multimedia',
+                            'unknown',
+                            'toys',
+                            'auto',
+                            'tools_and_professional_material',
+                            'health_and_beauty',
+                            'pet_shop',
+                            'baby',
+                            'watches_gifts',
+                            'art_cinema_music',
+                            'stationery',
+                            'fashion',
+                            'other',
+                            'books',
+                            'security',]
+
+payment_types = ['credit_card', 'debit_card', 'voucher',
+                 'boleto', 'not_defined']
+
 
 def values_per_payment_type_in_an_order(order_info):
     # Create a df where rows are all the distinct payments of the
@@ -313,27 +526,8 @@ def values_per_category_and_freight_in_an_order(order_info):
 
 
 def standardized_value_per_category_and_freight_in_an_order(val_per_cat_order):
-    large_product_categories = ['home',
-                                'sports_leisure',
-                                'electronics_and_multimedia',
-                                'unknown',
-                                'toys',
-                                'auto',
-                                'tools_and_professional_material',
-                                'health_and_beauty',
-                                'pet_shop',
-                                'baby',
-                                'watches_gifts',
-                                'art_cinema_music',
-                                'stationery',
-                                'fashion',
-                                'other',
-                                'books',
-                                'security',]
-    
-    n_cat = len(large_product_categories)
     idx_names = ['value_' + cat for cat in large_product_categories]
-    idx_names.append('freight')
+    idx_names.append('freight_value')
     
     standard_val_per_cat = pd.Series(np.zeros(len(idx_names)), idx_names)
     # Add each non-zero value
@@ -348,10 +542,6 @@ def standardized_value_per_category_and_freight_in_an_order(val_per_cat_order):
 
 
 def standardized_value_per_payment_type_in_an_order(val_per_pay_type):
-    payment_types = ['credit_card', 'debit_card', 'voucher',
-                    'boleto', 'not_defined']
-    
-    n_type = len(payment_types)
     idx_names = ['payment_value_' + cat for cat in payment_types]
     # default to 0 for all-type a priori
     standard_val_per_pay_type = pd.Series(np.zeros(len(idx_names)), idx_names)
@@ -363,8 +553,57 @@ def standardized_value_per_payment_type_in_an_order(val_per_pay_type):
         )
     return standard_val_per_pay_type  
 
-def make_unique_order_summary(order_info):
-    """ return a pd.Series with information of the order.
+def standardized_values_per_category_and_payment_type(client_info):
+    """ Return, for all the orders of client_info at once, the values per
+    category (and freight) and per payment type of the orders summary :
+    a df indexed by order_id with the 'value_<category>', 'freight_value'
+    and 'payment_value_<type>' columns.
+    
+    Categories and payment types are mapped to fixed column positions of
+    a preallocated (n_orders x n_columns) matrix filled with np.add.at."""
+    columns = [*['value_' + cat for cat in large_product_categories],
+               'freight_value',
+               *['payment_value_' + pay_type for pay_type in payment_types]]
+    freight_position = len(large_product_categories)
+    order_ids = pd.Index(client_info['order_id'].unique(), name='order_id')
+    values = np.zeros((len(order_ids), len(columns)))
+    
+    # Rows are items x payments : keep one row per item, then per payment.
+    items = (client_info
+             .drop_duplicates(['order_id', 'order_item_id'])
+             .dropna(subset=['large_product_category']))
+    payments = (client_info
+                .drop_duplicates(['order_id', 'payment_sequential'])
+                .dropna(subset=['payment_type']))
+    
+    category_positions = pd.Index(large_product_categories).get_indexer(
+        items.large_product_category
+    )
+    payment_positions = pd.Index(payment_types).get_indexer(
+        payments.payment_type
+    )
+    if (category_positions < 0).any() or (payment_positions < 0).any():
+        unknown = (
+            set(items.large_product_category[category_positions < 0])
+            | set(payments.payment_type[payment_positions < 0])
+        )
+        raise ValueError(f"Unknown categories or payment types : {unknown}")
+    payment_positions += freight_position + 1
+    
+    item_order_positions = order_ids.get_indexer(items.order_id)
+    np.add.at(values, (item_order_positions, category_positions),
+              items.price.fillna(0).to_numpy())
+    np.add.at(values[:, freight_position], item_order_positions,
+              items.freight_value.fillna(0).to_numpy())
+    np.add.at(values, (order_ids.get_indexer(payments.order_id),
+                       payment_positions),
+              payments.payment_value.fillna(0).to_numpy())
+    return pd.DataFrame(values, index=order_ids, columns=columns)
+
+
+def make_unique_order_base_summary(order_info):
+    """ return a pd.Series with information of the order, except its values
+    per category, freight and payment type.
     
     The 'customer_unique_id' ensures we can merge that information per client
     in a later step.
@@ -389,11 +628,18 @@ def make_unique_order_summary(order_info):
             'hour_of_purchase': s.purchase_time.hour,
             'weekday_of_purchase': s.purchase_time.day_of_week,
     })
+    return pd.concat([s, derived_s], axis=0)
+
+
+def make_unique_order_summary(order_info):
+    """ return a pd.Series with information of the order.
     
+    The 'customer_unique_id' ensures we can merge that information per client
+    in a later step.
+    """
     return pd.concat(
         [
-            s,
-            derived_s,
+            make_unique_order_base_summary(order_info),
             standardized_value_per_category_and_freight_in_an_order(
                 values_per_category_and_freight_in_an_order(order_info)
             ),
@@ -406,14 +652,105 @@ def make_unique_order_summary(order_info):
     )
 
 def make_orders_summary(client_info):
-    """ return a df in which each row is an order summary."""
-    # Empty dataframe to contain the
-    orders_summary = pd.DataFrame({})
-    # Build the client's orders summary, order by order.
-    for order_id, order_info in client_info.groupby('order_id').__iter__():
-        orders_summary[order_id] = make_unique_order_summary(order_info)
+    """ return a df in which each row is an order summary.
     
-    return orders_summary.T.reset_index(names=['order_id'])
+    Same rows as 'make_unique_order_summary' per order, but the values per
+    category, freight and payment type of all the orders are built at once
+    ('standardized_values_per_category_and_payment_type')."""
+    # Build the client's orders base summary, order by order.
+    orders_summary = pd.DataFrame({
+        order_id: make_unique_order_base_summary(order_info)
+        for order_id, order_info in client_info.groupby('order_id')
+    }).T
+    orders_summary = orders_summary.join(
+        standardized_values_per_category_and_payment_type(client_info)
+    )
+    return orders_summary.reset_index(names=['order_id'])
+
+def orders_source_hashes(client_info):
+    """ Return a pd.Series indexed by order_id with a hash of the content
+    of the source rows of each order (independent of the rows order). """
+    row_hashes = pd.util.hash_pandas_object(client_info, index=False)
+    codes, order_ids = pd.factorize(client_info['order_id'])
+    hashes = np.zeros(len(order_ids), dtype=np.uint64)
+    # Sum modulo 2**64 of the rows hashes
+    np.add.at(hashes, codes, row_hashes.to_numpy())
+    return pd.Series(hashes, index=order_ids, name='source_hash')
+
+
+def update_orders_summary_cache(client_info, cache_path,
+                                allow_fewer_rows=False):
+    """ Return the orders summary (as 'make_orders_summary') stored at
+    'cache_path', after computing and appending the summaries of the orders
+    of client_info which are new or whose source rows changed.
+    
+    Each stored summary is keyed by its order_id and the hash of its source
+    rows (see 'orders_source_hashes'). Stored orders absent from
+    client_info are kept, so it can be called with the rows of the new or
+    changed orders only, but client_info must hold ALL the source rows of
+    each order it contains : a summary is recomputed from these rows only.
+    A ValueError is raised when a cached order comes with fewer source rows
+    than it had (e.g. only its new payment row), unless 'allow_fewer_rows'
+    (rows really removed from the source)."""
+    hashes = orders_source_hashes(client_info)
+    counts = client_info.order_id.value_counts().reindex(hashes.index)
+    if os.path.exists(cache_path):
+        cache = pd.read_pickle(cache_path, compression=None)
+        orders_summary = cache['orders_summary']
+        cached_hashes = cache['source_hashes']
+        cached_counts = cache.get('source_counts',
+                                  pd.Series(dtype=np.int64))
+    else:
+        orders_summary = None
+        cached_hashes = pd.Series(dtype=np.uint64, name='source_hash')
+        cached_counts = pd.Series(dtype=np.int64)
+    
+    counts_ids = counts.index.intersection(cached_counts.index)
+    is_partial = (counts[counts_ids].to_numpy()
+                  < cached_counts[counts_ids].to_numpy())
+    if is_partial.any() and not allow_fewer_rows:
+        partial_ids = list(counts_ids[is_partial][:5])
+        raise ValueError(
+            f"{is_partial.sum()} cached orders (e.g. {partial_ids}) come with "
+            "fewer source rows than cached : pass all the rows of the "
+            "changed orders, or allow_fewer_rows=True if rows were removed.")
+    
+    common_ids = hashes.index.intersection(cached_hashes.index)
+    unchanged_ids = common_ids[hashes[common_ids].to_numpy()
+                               == cached_hashes[common_ids].to_numpy()]
+    ids_to_compute = hashes.index.difference(unchanged_ids)
+    print(f"{len(ids_to_compute)} orders summaries to compute, "
+          f"{len(unchanged_ids)} unchanged.")
+    if len(ids_to_compute) == 0:
+        return orders_summary
+    
+    new_orders_summary = make_orders_summary(
+        client_info[client_info.order_id.isin(ids_to_compute)]
+    )
+    if orders_summary is None:
+        orders_summary = new_orders_summary
+    else:
+        orders_summary = pd.concat(
+            [orders_summary[~orders_summary.order_id.isin(ids_to_compute)],
+             new_orders_summary],
+            ignore_index=True,
+        )
+    cached_hashes = pd.concat([
+        cached_hashes.drop(ids_to_compute, errors='ignore'),
+        hashes[ids_to_compute],
+    ])
+    cached_counts = pd.concat([
+        cached_counts.drop(ids_to_compute, errors='ignore'),
+        counts[ids_to_compute],
+    ])
+    # Write then rename, not to corrupt the cache if interrupted.
+    pd.to_pickle({'orders_summary': orders_summary,
+                  'source_hashes': cached_hashes,
+                  'source_counts': cached_counts},
+                 cache_path + '.tmp', compression=None)
+    os.replace(cache_path + '.tmp', cache_path)
+    return orders_summary
+
 
 ### Functions for post-processing all orders' summary according a certain date.
 def map_moment_of_the_day(hour):
@@ -570,8 +907,8 @@ def add_clients_dynamic_ratios(clients, threshold_old_clients = 90):
     The periods are define w.r.t. the first purchase time of each client.
     """
     # Default values
-    clients.loc[:, 'value_ratio_p2_p1'] = 1
-    clients.loc[:, 'n_purchases_ratio_p2_p1'] = 1
+    clients.loc[:, 'value_ratio_p2_p1'] = 1.
+    clients.loc[:, 'n_purchases_ratio_p2_p1'] = 1.
     
     # Finding old clients.
     old_clients_idx = (clients
@@ -670,12 +1007,142 @@ def clients_summary_post_processing(clients, threshold_old_clients = 90):
     return clients
 
 
-def make_clients_summary_relative_to_a_date_for_clustering(orders_df, date):
+# Features of the clients summary used for clustering
+clustering_features = ['monetary_value_sum', 'days_delivery_mean',
+                       'total_number_of_purchases', 'value_ratio_p2_p1', 
+                       'days_last_purchase', 'review_score_mean',
+                       'ratio_value_home',
+                       'ratio_value_electronics_and_multimedia',
+                       'ratio_value_health_and_beauty',
+                       'new_ratio_value_other',
+                       'ratio_freight_value',
+                       'ratio_payment_value_credit_card',
+                       'ratio_payment_value_boleto']
+
+
+# Projection pushdown : the client aggregations (name -> (orders summary
+# source column, function)) and the aggregations each feature of the
+# clients summary depends on, so that only those are computed.
+_summed_values = [*['value_' + cat for cat in large_product_categories],
+                  'freight_value',
+                  *['payment_value_' + pay for pay in payment_types]]
+# Summed in this order in 'clients_summary_post_processing'
+_other_categories = ['other', 'art_cinema_music', 'auto', 'baby', 'books',
+                     'fashion', 'pet_shop', 'security', 'sports_leisure',
+                     'stationery', 'tools_and_professional_material', 'toys',
+                     'watches_gifts', 'unknown']
+
+clients_aggregations = {
+    'monetary_value_sum': ('order_cost', 'sum'),
+    'total_number_of_purchases': ('order_cost', 'size'),
+    'days_delivery_mean': ('delay_purchase_delivery', 'mean'),
+    'review_score_mean': ('review_score', 'mean'),
+    'days_last_purchase': ('elapsed_days', 'min'),
+    'days_first_purchase': ('elapsed_days', 'max'),
+    **{col: (col, 'sum') for col in _summed_values},
+    # computed from 'days_first_purchase'
+    'value_spent_first_half': ('order_cost', None),
+    'value_spent_second_half': ('order_cost', None),
+}
+
+clients_features_dependencies = {
+    **{name: [name] for name in clients_aggregations},
+    'value_ratio_p2_p1': ['days_first_purchase',
+                          'value_spent_first_half',
+                          'value_spent_second_half'],
+    **{'ratio_' + col: ['monetary_value_sum', col] for col in _summed_values},
+    'new_ratio_value_other': ['monetary_value_sum',
+                              *['value_' + cat for cat in _other_categories]],
+}
+
+
+def make_clients_features_relative_to_a_date(orders_df, date, features,
+                                             threshold_old_clients=90):
+    """ Compute only the clients summary 'features' at 'date' from the
+    global orders summary df (not post-processed) : same values as
+    'make_clients_summary' followed by 'clients_summary_post_processing'
+    on the orders before 'date', but only the aggregations declared in
+    'clients_features_dependencies' are computed, in one groupby."""
+    unknown = [ft for ft in features if ft not in clients_features_dependencies]
+    if unknown:
+        raise ValueError(f'No dependencies declared for features {unknown}')
+    aggregations = list(dict.fromkeys(
+        agg for ft in features for agg in clients_features_dependencies[ft]))
+    if 'value_spent_first_half' in aggregations:
+        aggregations.insert(0, 'days_first_purchase')
+    
+    # Only the needed source columns of the orders before 'date'
+    elapsed_days = (pd.Timestamp(date) - orders_df.purchase_time).dt.days
+    is_before = elapsed_days > 0
+    sources = dict.fromkeys(clients_aggregations[agg][0]
+                            for agg in aggregations)
+    df = pd.DataFrame({
+        'customer_unique_id': orders_df.customer_unique_id[is_before],
+        **{col: orders_df.loc[is_before, col] for col in sources
+           if col not in ('elapsed_days', 'delay_purchase_delivery')},
+    })
+    if 'elapsed_days' in sources:
+        df['elapsed_days'] = elapsed_days[is_before]
+    if 'delay_purchase_delivery' in sources:
+        df['delay_purchase_delivery'] = (
+            orders_df.delivery_time - orders_df.purchase_time
+        )[is_before].dt.days
+    
+    grouped = df.groupby('customer_unique_id')
+    clients = grouped.agg(**{agg: clients_aggregations[agg]
+                             for agg in aggregations
+                             if clients_aggregations[agg][1] is not None})
+    if 'value_spent_first_half' in aggregations:
+        is_first_half = (df.elapsed_days
+                         >= grouped.elapsed_days.transform('max') / 2)
+        clients['value_spent_first_half'] = (
+            df.order_cost.where(is_first_half, 0)
+            .groupby(df.customer_unique_id).sum())
+        clients['value_spent_second_half'] = (
+            df.order_cost.where(~is_first_half, 0)
+            .groupby(df.customer_unique_id).sum())
+    
+    # Derived features, with the rounding and caps of
+    # 'clients_summary_post_processing'
+    for ft in features:
+        if ft == 'value_ratio_p2_p1':
+            ratio = (clients.value_spent_second_half
+                     / clients.value_spent_first_half).round(2)
+            ratio = ratio.where(
+                clients.days_first_purchase > threshold_old_clients, 1.)
+            clients[ft] = ratio.mask(ratio > 10, 10)
+        elif ft.startswith('ratio_'):
+            ratio = clients[ft[len('ratio_'):]] / clients.monetary_value_sum
+            clients[ft] = (ratio if ft == 'ratio_value_home'
+                           else ratio.mask(ratio >= 1, 1))
+        elif ft == 'new_ratio_value_other':
+            new_ratio = 0
+            for cat in _other_categories:
+                ratio = clients['value_' + cat] / clients.monetary_value_sum
+                new_ratio = new_ratio + ratio.mask(ratio >= 1, 1)
+            clients[ft] = new_ratio
+    return clients.loc[:, features]
+
+
+def make_clients_summary_relative_to_a_date_for_clustering(orders_df, date,
+                                                           features=None):
     """ Enable to simulate the client summary relatively to a certain
-    date from the global orders summary df (not post-processed)."""
+    date from the global orders summary df (not post-processed).
+    
+    Only the 'features' (default 'clustering_features') are computed, see
+    'make_clients_features_relative_to_a_date'. With features='all' the
+    complete clients summary is computed before selecting the
+    'clustering_features'."""
     ### Check
     print(f'Purchase_time dtype : {orders_df.purchase_time.dtype}')
     
+    if features is None:
+        features = clustering_features
+    if features != 'all':
+        clients = make_clients_features_relative_to_a_date(orders_df, date,
+                                                           features)
+        return clients.dropna(axis=0)
+    
     # Create a df with all raw orders summary previous to 'date'.
     df = orders_df.copy()
     df['examination_date'] = date
@@ -691,30 +1158,187 @@ def make_clients_summary_relative_to_a_date_for_clustering(orders_df, date):
     clients = make_clients_summary(df) 
     
     # Select what is needed for clustering
-    fts = ['monetary_value_sum', 'days_delivery_mean',
-           'total_number_of_purchases', 'value_ratio_p2_p1', 
-           'days_last_purchase', 'review_score_mean',
-           'ratio_value_home', 'ratio_value_electronics_and_multimedia',
-           'ratio_value_health_and_beauty', 'new_ratio_value_other',
-           'ratio_freight_value', 'ratio_payment_value_credit_card',
-           'ratio_payment_value_boleto']
-    
-    clients = clients.loc[:, fts]
+    clients = clients.loc[:, clustering_features]
     clients = clients.dropna(axis=0)
     return clients
 
 
-### CLUSTERING PRE-PROCESSING for the retained model ###
-def clustering_preprocessing(X: pd.DataFrame)-> pd.DataFrame:
-    """ Return pre-processed features.
+### POINT-IN-TIME (AS-OF) CLIENTS SUMMARY
+# Order summary columns summed per client by the as-of index.
+asof_summed_columns = ['order_cost',
+                       *['value_' + cat for cat in large_product_categories],
+                       'freight_value',
+                       *['payment_value_' + pay for pay in payment_types]]
+
+
+def make_asof_index(orders_df):
+    """ Precompute, from the global orders summary df (not post-processed),
+    an index giving the clients summary for clustering at any date with
+    'clients_summary_asof'.
     
-    Can take any clients summary as parameter X as long as it 
-    possesses the features listed below.
+    Orders are sorted by client then purchase time and keyed by
+    client_code * span + purchase time (in the finest unit that fits in
+    int64, exact for timestamps in whole seconds) ; the per-order values
+    are stored as prefix sums."""
+    codes, clients = pd.factorize(orders_df.customer_unique_id, sort=True)
+    times = (orders_df.purchase_time
+             .to_numpy(dtype='datetime64[ns]').astype(np.int64))
+    order = np.lexsort((times, codes))
+    codes, times = codes[order], times[order]
     
-    If more features are provide, it will automatically 
-    filter them."""
+    t_min = times.min()
+    for unit in (1, 10**3, 10**6, 10**9):
+        span = int(times.max() - t_min) // unit + 2
+        if len(clients) * span < 2**62:
+            break
+    keys = codes * span + (times - t_min) // unit
+    
+    df = orders_df.iloc[order]
+    delay = (df.delivery_time - df.purchase_time).dt.days.to_numpy(float)
+    review = df.review_score.to_numpy(float)
+    values = np.column_stack([
+        df.loc[:, asof_summed_columns].to_numpy(float),
+        delay, ~np.isnan(delay),
+        review, ~np.isnan(review),
+    ])
+    cumsums = np.zeros((len(values) + 1, values.shape[1]))
+    np.cumsum(np.nan_to_num(values), axis=0, out=cumsums[1:])
+    
+    return {'clients': clients,
+            'starts': np.searchsorted(codes, np.arange(len(clients))),
+            'keys': keys,
+            'times': times,
+            't_min': t_min,
+            'unit': unit,
+            'span': span,
+            'cumsums': cumsums,
+            'columns': [*asof_summed_columns,
+                        'delay_sum', 'delay_count',
+                        'review_score_sum', 'review_score_count']}
+
+
+def _asof_positions(index, codes, times):
+    """ Position (in the index orders) after the last order of each client
+    of 'codes' purchased at or before its time in 'times' (nanoseconds)."""
+    t_rel = np.clip((times - index['t_min']) // index['unit'],
+                    -1, index['span'] - 2)
+    return np.searchsorted(index['keys'], codes * index['span'] + t_rel,
+                           side='right')
+
+
+def rolling_window_columns(windows=(30, 90, 365)):
+    """ Names of the columns added by 'rolling_window_features'."""
+    return [col
+            for window in windows
+            for col in (f'number_of_purchases_last_{window}_days',
+                        f'monetary_value_last_{window}_days')]
+
+
+def rolling_window_features(index, dates, windows=(30, 90, 365)):
+    """ Return the number of purchases and the monetary value of each client
+    in the last 'windows' days (elapsed days from 1 to window, as the
+    orders of a clients summary at that date), using an index built by
+    'make_asof_index'.
+    
+    For a single date, the df is indexed by customer_unique_id (clients
+    with at least one order before the date), for a list of dates by
+    (date, customer_unique_id)."""
+    if isinstance(dates, (list, tuple, np.ndarray, pd.Index, pd.Series)):
+        return pd.concat(
+            {pd.Timestamp(date): rolling_window_features(index, date, windows)
+             for date in dates},
+            names=['date'])
+    
+    day = pd.Timedelta(days=1).value
+    date = pd.Timestamp(dates).value
+    codes = np.arange(len(index['clients']))
+    ends = _asof_positions(index, codes, date - day)
+    has_orders = ends > index['starts']
+    codes, ends = codes[has_orders], ends[has_orders]
+    costs = index['cumsums'][:, 0]
+    
+    features = {}
+    for window in windows:
+        window_starts = _asof_positions(index, codes,
+                                        date - (window + 1) * day)
+        features[f'number_of_purchases_last_{window}_days'] = (
+            ends - window_starts)
+        features[f'monetary_value_last_{window}_days'] = (
+            costs[ends] - costs[window_starts])
+    return pd.DataFrame(features,
+                        index=pd.Index(index['clients'][codes],
+                                       name='customer_unique_id'))
+
+
+def clients_summary_asof(index, date, windows=None):
+    """ Return the clients summary for clustering at 'date', as
+    'make_clients_summary_relative_to_a_date_for_clustering' does from
+    the orders summary, using an index built by 'make_asof_index'.
+    
+    With 'windows' (e.g. (30, 90, 365)), the 'rolling_window_features'
+    are added to the features.
+    
+    Costs O(clients * log(orders)), dates can be queried in any order."""
+    day = pd.Timedelta(days=1).value
+    date = pd.Timestamp(date).value
+    cumsums = index['cumsums']
+    
+    # Orders purchased at least one day before 'date'
+    codes = np.arange(len(index['clients']))
+    ends = _asof_positions(index, codes, date - day)
+    has_orders = ends > index['starts']
+    codes, starts, ends = (codes[has_orders], index['starts'][has_orders],
+                           ends[has_orders])
+    
+    days_first_purchase = (date - index['times'][starts]) // day
+    days_last_purchase = (date - index['times'][ends - 1]) // day
+    days_middle = days_first_purchase / 2
+    # First half : elapsed days >= days_middle
+    middles = _asof_positions(
+        index, codes, date - np.ceil(days_middle).astype(np.int64) * day)
+    
+    sums = pd.DataFrame(cumsums[ends] - cumsums[starts],
+                        columns=index['columns'])
+    value_spent_first_half = cumsums[middles, 0] - cumsums[starts, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clients = pd.DataFrame({
+            'monetary_value_sum': sums.order_cost,
+            'total_number_of_purchases': ends - starts,
+            'review_score_mean': (sums.review_score_sum
+                                  / sums.review_score_count),
+            'days_delivery_mean': sums.delay_sum / sums.delay_count,
+            **sums.loc[:, asof_summed_columns[1:]],
+            'days_last_purchase': days_last_purchase,
+            'days_first_purchase': days_first_purchase,
+            'days_middle': days_middle,
+            'number_of_purchases_first_half': middles - starts,
+            'number_of_purchases_second_half': ends - middles,
+            'value_spent_first_half': value_spent_first_half,
+            'value_spent_second_half': (sums.order_cost
+                                        - value_spent_first_half),
+        })
+    clients.index = pd.Index(index['clients'][codes],
+                             name='customer_unique_id')
+    
+    clients = clients_summary_post_processing(clients)
+    clients = clients.loc[:, clustering_features]
+    if windows is not None:
+        clients = clients.join(rolling_window_features(index, date, windows))
+    clients = clients.dropna(axis=0)
+    return clients
+
+
+### CLUSTERING PRE-PROCESSING for the retained model ###
+def make_clustering_preprocessor(extra_fts_to_logscale=()):
+    """ Return (pre_processor, all_fts) : the unfit pre-processor of the
+    retained clustering model and the list of the features it outputs,
+    in order.
+    
+    'extra_fts_to_logscale' are additional features (e.g. the
+    'rolling_window_columns') log-transformed then scaled."""
     fts_to_logscale = ['monetary_value_sum',
-                       'days_delivery_mean',] 
+                       'days_delivery_mean',
+                       *extra_fts_to_logscale] 
 
     fts_to_log_only = ['total_number_of_purchases', 
                        'value_ratio_p2_p1', ]                  
@@ -743,6 +1367,21 @@ def clustering_preprocessing(X: pd.DataFrame)-> pd.DataFrame:
         (StandardScaler(), fts_to_scale_only),
         ('passthrough', fts_passthrough),
     )
+    return pre_processor, all_fts
+
+
+def clustering_preprocessing(X: pd.DataFrame,
+                             extra_fts_to_logscale=())-> pd.DataFrame:
+    """ Return pre-processed features.
+    
+    Can take any clients summary as parameter X as long as it 
+    possesses the features listed in 'make_clustering_preprocessor'
+    (and the 'extra_fts_to_logscale').
+    
+    If more features are provide, it will automatically 
+    filter them."""
+    pre_processor, all_fts = make_clustering_preprocessor(
+        extra_fts_to_logscale)
     
     # print('PRE-PROCESSING')
     # print(f'X shape :{X.shape}')
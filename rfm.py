@@ -0,0 +1,108 @@
+import pandas as pd
+import numpy as np
+
+
+# Fixed thresholds scoring recency (days), frequency (purchases) and
+# monetary value : a value above k thresholds scores k + 1 (reversed for
+# recency, the most recent clients score the highest).
+default_rfm_thresholds = {
+    'recency': [30, 90, 180, 365],
+    'frequency': [1, 2, 3, 5],
+    'monetary': [50, 100, 200, 500],
+}
+
+
+def _rfm_aggregates(orders_df, date):
+    """ Per client last purchase time, number of purchases and monetary
+    value of the orders purchased at least one day before 'date' (as in
+    the clients summaries)."""
+    date = pd.Timestamp(date)
+    is_before = (date - orders_df.purchase_time).dt.days > 0
+    return (orders_df
+            .loc[is_before, ['customer_unique_id', 'purchase_time',
+                             'order_cost']]
+            .groupby('customer_unique_id')
+            .agg(last_purchase_time=('purchase_time', 'max'),
+                 frequency=('purchase_time', 'size'),
+                 monetary=('order_cost', 'sum')))
+
+
+def _with_recency(aggregates, date):
+    rfm = aggregates.copy()
+    rfm.insert(0, 'recency',
+               (pd.Timestamp(date) - rfm.last_purchase_time).dt.days)
+    return rfm
+
+
+def compute_rfm(orders_df, date):
+    """ Return the recency (days since the last purchase), frequency
+    (number of purchases) and monetary value of each client at 'date',
+    from the orders summary df, indexed by customer_unique_id.
+
+    The 'last_purchase_time' column enables 'update_rfm'."""
+    return _with_recency(_rfm_aggregates(orders_df, date), date)
+
+
+def update_rfm(rfm, new_orders_df, date):
+    """ Update the 'rfm' df of 'compute_rfm' (or 'update_rfm') with the
+    orders of 'new_orders_df' only, and move it to 'date'.
+
+    'new_orders_df' must hold the orders which were not counted in 'rfm'
+    (purchased after its date minus one day)."""
+    new = _rfm_aggregates(new_orders_df, date)
+    old = rfm.drop(columns='recency')
+    aggregates = pd.concat([old, new])
+    aggregates = (aggregates
+                  .groupby(level=0, sort=False)
+                  .agg({'last_purchase_time': 'max',
+                        'frequency': 'sum',
+                        'monetary': 'sum'}))
+    aggregates.index.name = 'customer_unique_id'
+    return _with_recency(aggregates, date)
+
+
+def _quantile_edges(values, n_scores):
+    """ Inner edges cutting the values in n_scores quantile groups ; equal
+    edges (many tied values) are merged, giving less groups."""
+    return np.unique(np.quantile(values, np.linspace(0, 1, n_scores + 1)[1:-1]))
+
+
+def score_rfm(rfm, method='quantile', n_scores=5, thresholds=None):
+    """ Add the r/f/m scores (the higher the better) to the 'rfm' df of
+    'compute_rfm', with their 'rfm_segment' code (e.g. '545', categorical)
+    and 'rfm_score' sum.
+
+    method='quantile' cuts each feature at its 'n_scores' quantiles,
+    method='thresholds' uses the 'thresholds' dict (default
+    'default_rfm_thresholds'). Identical values always get the same
+    score : with many ties (e.g. most clients buying once) quantiles
+    merge and a feature can have less than 'n_scores' levels."""
+    rfm = rfm.copy()
+    n_maxs = []
+    for feature, score in (('recency', 'r_score'),
+                           ('frequency', 'f_score'),
+                           ('monetary', 'm_score')):
+        if method == 'quantile':
+            edges = _quantile_edges(rfm[feature].to_numpy(), n_scores)
+        elif method == 'thresholds':
+            edges = (thresholds or default_rfm_thresholds)[feature]
+        else:
+            raise ValueError(f"Unknown scoring method '{method}'")
+        # A value above k edges scores k + 1
+        scores = np.searchsorted(edges, rfm[feature].to_numpy(),
+                                 side='left') + 1
+        n_max = len(edges) + 1
+        if feature == 'recency':
+            scores = n_max + 1 - scores
+        rfm[score] = scores
+        n_maxs.append(n_max)
+    # Categorical codes rather than millions of string concatenations
+    n_r, n_f, n_m = n_maxs
+    rfm['rfm_segment'] = pd.Categorical.from_codes(
+        ((rfm.r_score - 1) * n_f + rfm.f_score - 1) * n_m + rfm.m_score - 1,
+        [f'{r}{f}{m}'
+         for r in range(1, n_r + 1)
+         for f in range(1, n_f + 1)
+         for m in range(1, n_m + 1)])
+    rfm['rfm_score'] = rfm.r_score + rfm.f_score + rfm.m_score
+    return rfm
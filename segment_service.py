@@ -0,0 +1,310 @@
+import json
+import queue
+import pickle
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import numpy as np
+
+import project_tools_v2 as pt
+
+
+### FROZEN SEGMENT MODEL
+def _freeze_pre_processor(pre_processor):
+    """ Turn a fitted clustering pre-processor (see
+    'pt.make_clustering_preprocessor') into plain arrays so that scoring a
+    single row does not pay the per-call overhead of sklearn.
+
+    Return (features, log_mask, shift, scale) : the input features in
+    output order, the features to log1p, and the scaling applied after."""
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import FunctionTransformer, StandardScaler
+
+    features, log_mask, shift, scale = [], [], [], []
+    for name, transformer, cols in pre_processor.transformers_:
+        if name == 'remainder':
+            continue
+        steps = ([step for _, step in transformer.steps]
+                 if isinstance(transformer, Pipeline) else [transformer])
+        is_log = False
+        mean = np.zeros(len(cols))
+        std = np.ones(len(cols))
+        for step in steps:
+            if isinstance(step, str) and step == 'passthrough':
+                continue
+            elif isinstance(step, FunctionTransformer) and step.func is None:
+                continue
+            elif (isinstance(step, FunctionTransformer)
+                  and step.func is np.log1p):
+                is_log = True
+            elif isinstance(step, StandardScaler):
+                mean, std = step.mean_, step.scale_
+            else:
+                raise ValueError(f"Can't freeze the '{name}' transformer "
+                                 f"step : {step!r}")
+        features += list(cols)
+        log_mask += [is_log] * len(cols)
+        shift = np.concatenate([shift, mean])
+        scale = np.concatenate([scale, std])
+    return features, np.array(log_mask), shift, scale
+
+
+def freeze_segment_model(clients, kmeans):
+    """ Freeze the retained clustering model : the pre-processor fitted on
+    the 'clients' summary 'kmeans' was trained on (after
+    'pt.clustering_preprocessing') and the centroids of 'kmeans'."""
+    pre_processor, _ = pt.make_clustering_preprocessor()
+    pre_processor.fit(clients)
+    features, log_mask, shift, scale = _freeze_pre_processor(pre_processor)
+    return {'features': features,
+            'log_mask': log_mask,
+            'shift': shift,
+            'scale': scale,
+            'centroids': np.asarray(kmeans.cluster_centers_, dtype=float)}
+
+
+def save_segment_model(model, path):
+    """ Save a model returned by 'freeze_segment_model' at 'path'."""
+    with open(path, 'wb') as f:
+        pickle.dump(model, f)
+
+
+def load_segment_model(path):
+    """ Load a model saved by 'save_segment_model'."""
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def segment_features(model, clients):
+    """ Return the features of 'model' of the raw 'clients' summary rows as
+    a float df, raise a ValueError if some are missing or not numeric."""
+    missing = [ft for ft in model['features'] if ft not in clients.columns]
+    if missing:
+        raise ValueError(f'Missing client features : {missing}')
+    try:
+        return clients.loc[:, model['features']].astype(float)
+    except (ValueError, TypeError) as error:
+        raise ValueError(f'Non numeric client features : {error}') from None
+
+
+def segment_preprocessing(model, clients):
+    """ Return the pre-processed features of the raw 'clients' summary rows
+    as an array, identical to 'pt.clustering_preprocessing' with the
+    pre-processor frozen in 'model'."""
+    X = segment_features(model, clients).to_numpy(copy=True)
+    X[:, model['log_mask']] = np.log1p(X[:, model['log_mask']])
+    return (X - model['shift']) / model['scale']
+
+
+def assign_segments(model, clients):
+    """ Assign the raw 'clients' summary rows to the nearest centroid of
+    'model'.
+
+    Return a DataFrame indexed like 'clients' with the 'label' of each row
+    and its 'distance_<k>' to each centroid k. Rows with missing features
+    get label -1 and NaN distances."""
+    Xpp = segment_preprocessing(model, clients)
+    centroids = model['centroids']
+    distances = np.sqrt(((Xpp[:, None, :] - centroids[None, :, :]) ** 2)
+                        .sum(axis=2))
+    is_complete = ~np.isnan(Xpp).any(axis=1)
+    labels = np.full(len(Xpp), -1)
+    if is_complete.any():
+        labels[is_complete] = distances[is_complete].argmin(axis=1)
+    segments = pd.DataFrame(
+        distances, index=clients.index,
+        columns=[f'distance_{k}' for k in range(len(centroids))])
+    segments.insert(0, 'label', labels)
+    return segments
+
+
+
+### BATCH SCORING
+def nearest_centroids(Xpp, centroids, block_rows=65536, dtype=np.float32):
+    """ Return (labels, distances) : the nearest centroid of each row of the
+    pre-processed features 'Xpp' and the distance to it.
+
+    Squared distances are computed by blocks of 'block_rows' rows as
+    ||x||**2 - 2 x.c + ||c||**2 in 'dtype' (one BLAS matrix product per
+    block), so that memory stays bounded by block_rows * n_centroids.
+    Rows with missing values get label -1 and a NaN distance."""
+    centroids = np.asarray(centroids, dtype=dtype)
+    centroids_sq_norms = (centroids ** 2).sum(axis=1)
+    labels = np.empty(len(Xpp), dtype=np.int64)
+    distances = np.empty(len(Xpp), dtype=dtype)
+    for start in range(0, len(Xpp), block_rows):
+        X = np.asarray(Xpp[start:start + block_rows], dtype=dtype)
+        sq_distances = X @ centroids.T
+        sq_distances *= -2
+        sq_distances += centroids_sq_norms
+        block_labels = sq_distances.argmin(axis=1)
+        min_sq_distances = (sq_distances[np.arange(len(X)), block_labels]
+                            + (X ** 2).sum(axis=1))
+        is_complete = ~np.isnan(X).any(axis=1)
+        labels[start:start + len(X)] = np.where(is_complete, block_labels, -1)
+        distances[start:start + len(X)] = np.sqrt(
+            np.maximum(min_sq_distances, 0))
+    return labels, distances
+
+
+def score_segments_batch(model, input_path, output_path, chunksize=100000,
+                         index_col='customer_unique_id', block_rows=65536):
+    """ Assign the segments of the client summaries of the CSV file
+    'input_path', streamed by chunks of 'chunksize' rows (only the index
+    and features columns are read), and append them chunk by chunk to the
+    CSV file 'output_path' : index, 'label' and 'distance' to the centroid
+    (see 'nearest_centroids').
+
+    Return a dict with the number of rows, the duration and the throughput
+    (rows per second)."""
+    start = time.perf_counter()
+    n_rows = 0
+    chunks = pd.read_csv(input_path, chunksize=chunksize, index_col=index_col,
+                         usecols=[index_col, *model['features']])
+    for n, clients in enumerate(chunks):
+        labels, distances = nearest_centroids(
+            segment_preprocessing(model, clients), model['centroids'],
+            block_rows=block_rows)
+        pd.DataFrame({'label': labels, 'distance': distances},
+                     index=clients.index).to_csv(
+            output_path, mode='w' if n == 0 else 'a', header=n == 0)
+        n_rows += len(clients)
+    duration = time.perf_counter() - start
+    throughput = {'n_rows': n_rows,
+                  'seconds': duration,
+                  'rows_per_second': n_rows / duration if duration else np.nan}
+    print(f"{n_rows} clients scored in {duration:.1f}s "
+          f"({throughput['rows_per_second']:.0f} rows/s)")
+    return throughput
+
+
+### SERVING
+class SegmentMicroBatcher:
+    """ Score the rows of concurrent requests together.
+
+    Requests are queued and a background thread assigns them in
+    micro-batches, closed when they reach 'max_batch_rows' rows or when
+    their first request waited 'max_wait_ms' milliseconds."""
+
+    def __init__(self, model, max_batch_rows=1024, max_wait_ms=2):
+        self.model = model
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, clients):
+        """ Queue the 'clients' rows, return a Future of their segments.
+
+        Each request is validated on its own ('segment_features'), so that
+        an invalid request only fails its own future."""
+        future = Future()
+        try:
+            clients = segment_features(self.model, clients)
+        except ValueError as error:
+            future.set_exception(error)
+            return future
+        self._requests.put((clients, future))
+        return future
+
+    def assign(self, clients, timeout=None):
+        """ Same as 'assign_segments', through the micro-batches."""
+        return self.submit(clients).result(timeout)
+
+    def close(self):
+        """ Score the queued requests and stop the background thread."""
+        self._requests.put(None)
+        self._thread.join()
+
+    def _run(self):
+        is_closing = False
+        while not is_closing:
+            request = self._requests.get()
+            if request is None:
+                return
+            batch = []
+            n_rows = 0
+            deadline = time.perf_counter() + self.max_wait
+            while True:
+                # Cancelled requests are dropped, the others can't be
+                # cancelled anymore.
+                if request[1].set_running_or_notify_cancel():
+                    batch.append(request)
+                    n_rows += len(request[0])
+                if n_rows >= self.max_batch_rows:
+                    break
+                try:
+                    request = self._requests.get(
+                        timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    is_closing = True
+                    break
+            if not batch:
+                continue
+            try:
+                self._score(batch)
+            except Exception as error:
+                # Never let the background thread die with pending futures
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _score(self, batch):
+        try:
+            segments = assign_segments(
+                self.model, pd.concat([clients for clients, _ in batch]))
+        except Exception as error:
+            if len(batch) > 1:
+                # Isolate the failing request(s)
+                for request in batch:
+                    self._score([request])
+            else:
+                batch[0][1].set_exception(error)
+            return
+        start = 0
+        for clients, future in batch:
+            future.set_result(segments.iloc[start:start + len(clients)])
+            start += len(clients)
+
+
+def make_segment_server(model, host='127.0.0.1', port=8000, **kwargs):
+    """ Return an HTTP server assigning segments, to run with
+    'server.serve_forever()' ('server.batcher.close()' after shutdown).
+
+    POST a JSON list of client summary records (optionally with their
+    'customer_unique_id') and get back the list of their label and
+    centroid distances. kwargs are passed to SegmentMicroBatcher."""
+    batcher = SegmentMicroBatcher(model, **kwargs)
+
+    class SegmentRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                records = json.loads(
+                    self.rfile.read(int(self.headers['Content-Length'])))
+                clients = pd.DataFrame.from_records(records)
+                if 'customer_unique_id' in clients.columns:
+                    clients = clients.set_index('customer_unique_id')
+                body = (batcher.assign(clients).reset_index()
+                        .to_json(orient='records').encode())
+                status = 200
+            except (ValueError, KeyError, TypeError) as error:
+                body = json.dumps({'error': str(error)}).encode()
+                status = 400
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), SegmentRequestHandler)
+    server.batcher = batcher
+    return server